@@ -1,11 +1,17 @@
+import os
 import sys
 import io
 import time
-import json
 import threading
 import traceback
 import collections
-import bisect
+import itertools
+import heapq
+
+try:
+    from collections.abc import Hashable as _Hashable
+except ImportError:
+    from collections import Hashable as _Hashable
 
 try:
     import Queue as queue
@@ -16,6 +22,8 @@ except ImportError:
 from . import hack
 
 from . import exception
+from . import codec
+from .retry import RetryPolicy
 
 
 __version_info__ = (12, 7)
@@ -39,16 +47,13 @@ def flavor(msg):
     """
     if 'message_id' in msg:
         return 'chat'
-    elif 'id' in msg and 'chat_instance' in msg:
-        return 'callback_query'
-    elif 'id' in msg and 'query' in msg:
-        return 'inline_query'
-    elif 'result_id' in msg:
+    elif 'id' in msg:
+        for key, f in _id_flavors:
+            if key in msg:
+                return f
+
+    if 'result_id' in msg:
         return 'chosen_inline_result'
-    elif 'id' in msg and 'shipping_address' in msg:
-        return 'shipping_query'
-    elif 'id' in msg and 'total_amount' in msg:
-        return 'pre_checkout_query'
     else:
         top_keys = list(msg.keys())
         if len(top_keys) == 1:
@@ -56,6 +61,14 @@ def flavor(msg):
 
         raise exception.BadFlavor(msg)
 
+# Flavors of messages having an `id`, told apart by one other key, in order of precedence
+_id_flavors = [
+    ('chat_instance', 'callback_query'),
+    ('query', 'inline_query'),
+    ('shipping_address', 'shipping_query'),
+    ('total_amount', 'pre_checkout_query'),
+]
+
 
 chat_flavors = ['chat']
 inline_flavors = ['inline_query', 'chosen_inline_result']
@@ -76,6 +89,24 @@ all_content_types = [
     'new_chat_members', 'invoice', 'successful_payment'
 ]
 
+_content_type_rank = {t: i for i,t in enumerate(all_content_types)}
+_content_type_set = frozenset(all_content_types)
+
+def _content_type(msg):
+    if 'text' in msg:
+        return 'text'  # most common, and first in list anyway
+
+    found = _content_type_set.intersection(msg)
+
+    if len(found) == 1:
+        return next(iter(found))
+    elif found:
+        # e.g. `new_chat_member` and `new_chat_members`. Earliest in list wins.
+        return min(found, key=_content_type_rank.__getitem__)
+    else:
+        # Maybe a content type appended to `all_content_types` at runtime
+        return _find_first_key(msg, all_content_types)
+
 def glance(msg, flavor='chat', long=False):
     """
     Extract "headline" info about a message.
@@ -120,46 +151,51 @@ def glance(msg, flavor='chat', long=False):
     - short: (``msg['id']``, ``msg['from']['id']``, ``msg['invoice_payload']``)
     - long: (``msg['id']``, ``msg['from']['id']``, ``msg['invoice_payload']``, ``msg['currency']``, ``msg['total_amount']``)
     """
-    def gl_chat():
-        content_type = _find_first_key(msg, all_content_types)
+    try:
+        fn = _glancers[flavor]
+    except KeyError:
+        raise exception.BadFlavor(flavor)
 
-        if long:
-            return content_type, msg['chat']['type'], msg['chat']['id'], msg['date'], msg['message_id']
-        else:
-            return content_type, msg['chat']['type'], msg['chat']['id']
+    return fn(msg, long)
 
-    def gl_callback_query():
-        return msg['id'], msg['from']['id'], msg['data']
 
-    def gl_inline_query():
-        if long:
-            return msg['id'], msg['from']['id'], msg['query'], msg['offset']
-        else:
-            return msg['id'], msg['from']['id'], msg['query']
+def _gl_chat(msg, long):
+    content_type = _content_type(msg)
 
-    def gl_chosen_inline_result():
-        return msg['result_id'], msg['from']['id'], msg['query']
+    if long:
+        return content_type, msg['chat']['type'], msg['chat']['id'], msg['date'], msg['message_id']
+    else:
+        return content_type, msg['chat']['type'], msg['chat']['id']
 
-    def gl_shipping_query():
-        return msg['id'], msg['from']['id'], msg['invoice_payload']
+def _gl_callback_query(msg, long):
+    return msg['id'], msg['from']['id'], msg['data']
 
-    def gl_pre_checkout_query():
-        if long:
-            return msg['id'], msg['from']['id'], msg['invoice_payload'], msg['currency'], msg['total_amount']
-        else:
-            return msg['id'], msg['from']['id'], msg['invoice_payload']
+def _gl_inline_query(msg, long):
+    if long:
+        return msg['id'], msg['from']['id'], msg['query'], msg['offset']
+    else:
+        return msg['id'], msg['from']['id'], msg['query']
 
-    try:
-        fn = {'chat': gl_chat,
-              'callback_query': gl_callback_query,
-              'inline_query': gl_inline_query,
-              'chosen_inline_result': gl_chosen_inline_result,
-              'shipping_query': gl_shipping_query,
-              'pre_checkout_query': gl_pre_checkout_query}[flavor]
-    except KeyError:
-        raise exception.BadFlavor(flavor)
+def _gl_chosen_inline_result(msg, long):
+    return msg['result_id'], msg['from']['id'], msg['query']
+
+def _gl_shipping_query(msg, long):
+    return msg['id'], msg['from']['id'], msg['invoice_payload']
+
+def _gl_pre_checkout_query(msg, long):
+    if long:
+        return msg['id'], msg['from']['id'], msg['invoice_payload'], msg['currency'], msg['total_amount']
+    else:
+        return msg['id'], msg['from']['id'], msg['invoice_payload']
 
-    return fn()
+_glancers = {
+    'chat': _gl_chat,
+    'callback_query': _gl_callback_query,
+    'inline_query': _gl_inline_query,
+    'chosen_inline_result': _gl_chosen_inline_result,
+    'shipping_query': _gl_shipping_query,
+    'pre_checkout_query': _gl_pre_checkout_query,
+}
 
 
 def flance(msg, long=False):
@@ -304,6 +340,30 @@ def _isfile(f):
     return isinstance(f, _file_type)
 
 
+class Prepared(str):
+    """
+    A parameter value serialized ahead of time. Use it when sending the same
+    ``reply_markup``, inline query ``results``, etc. many times, so it is not
+    serialized again on every call::
+
+        keyboard = Prepared(InlineKeyboardMarkup(inline_keyboard=[[...]]))
+
+        for chat_id in chat_ids:
+            bot.sendMessage(chat_id, 'Hello', reply_markup=keyboard)
+
+    The original value is kept as ``value``. Changing it afterwards does not
+    affect the serialized form.
+
+    It saves work only as a parameter by itself. Nested inside another value,
+    e.g. as an inline query result's ``reply_markup``, its ``value`` is serialized
+    along with the rest.
+    """
+    def __new__(cls, value):
+        p = super(Prepared, cls).__new__(cls, _flatten(value))
+        p.value = value
+        return p
+
+
 from . import helper
 
 def flavor_router(routing_table):
@@ -320,46 +380,173 @@ class _BotBase(object):
 def _strip(params, more=[]):
     return {key: value for key,value in params.items() if key not in ['self']+more}
 
-def _rectify(params):
-    def make_jsonable(value):
-        if isinstance(value, list):
-            return [make_jsonable(v) for v in value]
-        elif isinstance(value, dict):
-            return {k:make_jsonable(v) for k,v in value.items() if v is not None}
-        elif isinstance(value, tuple) and hasattr(value, '_asdict'):
-            return {k:make_jsonable(v) for k,v in value._asdict().items() if v is not None}
-        else:
-            return value
+def _make_jsonable(value):
+    if isinstance(value, Prepared):
+        return _make_jsonable(value.value)  # nested, else it would be a JSON string
+    elif isinstance(value, list):
+        return [_make_jsonable(v) for v in value]
+    elif isinstance(value, dict):
+        return {k:_make_jsonable(v) for k,v in value.items() if v is not None}
+    elif isinstance(value, tuple) and hasattr(value, '_asdict'):
+        return {k:_make_jsonable(v) for k,v in value._asdict().items() if v is not None}
+    else:
+        return value
 
-    def flatten(value):
-        v = make_jsonable(value)
+def _flatten(value):
+    if isinstance(value, Prepared):
+        return value
 
-        if isinstance(v, (dict, list)):
-            return json.dumps(v, separators=(',',':'))
-        else:
-            return v
+    v = _make_jsonable(value)
+
+    if isinstance(v, (dict, list)):
+        return codec.dumps(v)
+    else:
+        return v
 
+def _rectify(params):
     # remove None, then json-serialize if needed
-    return {k: flatten(v) for k,v in params.items() if v is not None}
+    return {k: _flatten(v) for k,v in params.items() if v is not None}
+
+
+class _Checkpoint(object):
+    # Count how many leading items of a sequence are done, even if they complete
+    # out of order, and save the count to a file to resume from.
+    def __init__(self, path, every=100):
+        self._path = path
+        self._every = every
+        self._done = set()
+        self._unsaved = 0
+        self.count = self._load()
+
+    def _load(self):
+        if self._path is None:
+            return 0
+        try:
+            with open(self._path) as f:
+                return int(f.read().strip() or 0)
+        except IOError:  # no such file
+            return 0
+
+    def done(self, index):
+        self._done.add(index)
+        while self.count in self._done:
+            self._done.remove(self.count)
+            self.count += 1
+
+        self._unsaved += 1
+        if self._unsaved >= self._every:
+            self.save()
+
+    def save(self):
+        if self._path is None:
+            return
+
+        # Write to a temporary file, then rename over, so an interruption
+        # never leaves a half-written checkpoint.
+        tmp = self._path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(str(self.count))
+        getattr(os, 'replace', os.rename)(tmp, self._path)
+        self._unsaved = 0
+
+
+class _ReorderBuffer(object):
+    # Deliver updates in order of `update_id`. An update arriving early is held
+    # until the missing ones arrive, or until `maxhold` seconds after the gap
+    # appeared, after which the missing ones are given up.
+    #
+    # Memory and time scale with the number of updates held, not the size of
+    # gaps. Gaps are kept as segments `(last_id, expire)`: every missing id
+    # up to `last_id` (and after the previous segment) expires at `expire`.
+    # Later gaps never expire earlier, so only the first segment matters.
+    def __init__(self, handle, maxhold=3):
+        self._handle = handle
+        self._maxhold = maxhold
+        self._max_id = None   # max update_id passed to handle
+        self._high = None     # max update_id seen
+        self._held = {}       # {update_id: update}
+        self._heap = []       # update_ids held
+        self._gaps = collections.deque()
+
+    def _advance(self, update):
+        self._max_id = update['update_id']
+        while self._gaps and self._gaps[0][0] <= self._max_id:
+            self._gaps.popleft()
+        self._handle(update)
+
+    def _drain(self):
+        # Handle held updates following on from max_id.
+        while self._heap and self._heap[0] == self._max_id + 1:
+            self._advance(self._held.pop(heapq.heappop(self._heap)))
+
+    def put(self, update, now=None):
+        update_id = update['update_id']
+
+        if self._max_id is None:
+            # First update received, handle regardless.
+            self._high = update_id
+            self._advance(update)
+
+        elif update_id == self._max_id + 1:
+            # No update_id skipped, handle naturally.
+            self._high = max(self._high, update_id)
+            self._advance(update)
+            self._drain()
+
+        elif update_id > self._max_id + 1:
+            # Update arrives prematurely, hold it.
+            if update_id not in self._held:
+                heapq.heappush(self._heap, update_id)
+            self._held[update_id] = update
+
+            if update_id > self._high:
+                self._gaps.append((update_id, (time.time() if now is None else now) + self._maxhold))
+                self._high = update_id
+
+        else:
+            pass  # discard
+
+    def flush(self, now=None):
+        """ Handle held updates, giving up on gaps that have expired. """
+        now = time.time() if now is None else now
+        while self._heap:
+            if self._heap[0] == self._max_id + 1:
+                self._drain()
+            elif self._gaps[0][1] <= now:
+                # Give up on missing ids up to the next held update.
+                self._max_id = self._heap[0] - 1
+            else:
+                break
 
+    def wait_time(self, now=None):
+        """
+        :return:
+            seconds until :meth:`flush` has something to do;
+            ``None`` if nothing is held.
+        """
+        if not self._heap:
+            return None
+        elif self._heap[0] == self._max_id + 1:
+            return 0
+        else:
+            return max(0, self._gaps[0][1] - (time.time() if now is None else now))
 
 from . import api
 
 class Bot(_BotBase):
     class Scheduler(threading.Thread):
-        # A class that is sorted by timestamp. Use `bisect` module to ensure order in event queue.
+        # Events are kept in a binary heap, ordered by timestamp. Ties are broken by
+        # an increasing sequence number, so events themselves are never compared.
         Event = collections.namedtuple('Event', ['timestamp', 'data'])
-        Event.__eq__ = lambda self, other: self.timestamp == other.timestamp
-        Event.__ne__ = lambda self, other: self.timestamp != other.timestamp
-        Event.__gt__ = lambda self, other: self.timestamp > other.timestamp
-        Event.__ge__ = lambda self, other: self.timestamp >= other.timestamp
-        Event.__lt__ = lambda self, other: self.timestamp < other.timestamp
-        Event.__le__ = lambda self, other: self.timestamp <= other.timestamp
 
         def __init__(self):
             super(Bot.Scheduler, self).__init__()
-            self._eventq = []
+            self._eventq = []             # heap of (timestamp, sequence, event)
+            self._pending = {}            # id(event) --> event, for events yet to be emitted
+            self._cancelled = 0           # number of cancelled events still lying in heap
+            self._sequence = itertools.count()
             self._lock = threading.RLock()  # reentrant lock to allow locked method calling locked method
+            self._wakeup = threading.Condition(self._lock)
             self._event_handler = None
 
         def _locked(fn):
@@ -368,43 +555,65 @@ class Bot(_BotBase):
                     return fn(self, *args, **kwargs)
             return k
 
+        def _is_pending(self, event):
+            # An event object stays referenced by the heap until popped, so its id
+            # cannot be reused by another event in the meantime.
+            return self._pending.get(id(event)) is event
+
         @_locked
         def _insert_event(self, data, when):
             ev = self.Event(when, data)
-            bisect.insort(self._eventq, ev)
+            heapq.heappush(self._eventq, (when, next(self._sequence), ev))
+            self._pending[id(ev)] = ev
+
+            # Wake up the scheduler thread if this is the earliest event.
+            if self._eventq[0][2] is ev:
+                self._wakeup.notify()
             return ev
 
         @_locked
         def _remove_event(self, event):
-            # Find event according to its timestamp.
-            # Index returned should be one behind.
-            i = bisect.bisect(self._eventq, event)
-
-            # Having two events with identical timestamp is unlikely but possible.
-            # I am going to move forward and compare timestamp AND object address
-            # to make sure the correct object is found.
-
-            while i > 0:
-                i -= 1
-                e = self._eventq[i]
-
-                if e.timestamp != event.timestamp:
-                    raise exception.EventNotFound(event)
-                elif id(e) == id(event):
-                    self._eventq.pop(i)
-                    return
+            if not self._is_pending(event):
+                raise exception.EventNotFound(event)
+
+            # Do not search the heap. Just forget the event, and leave it in the heap
+            # as a tombstone to be discarded when it reaches the top.
+            del self._pending[id(event)]
+            self._cancelled += 1
 
-            raise exception.EventNotFound(event)
+            # Rebuild the heap if tombstones make up most of it.
+            if self._cancelled > 64 and self._cancelled * 2 > len(self._eventq):
+                self._eventq = [e for e in self._eventq if self._is_pending(e[2])]
+                heapq.heapify(self._eventq)
+                self._cancelled = 0
 
         @_locked
         def _pop_expired_event(self):
-            if not self._eventq:
-                return None
+            while self._eventq:
+                timestamp, _, ev = self._eventq[0]
+
+                if not self._is_pending(ev):
+                    heapq.heappop(self._eventq)  # discard tombstone
+                    self._cancelled -= 1
+                elif timestamp <= time.time():
+                    heapq.heappop(self._eventq)
+                    del self._pending[id(ev)]
+                    return ev
+                else:
+                    return None
+            return None
 
-            if self._eventq[0].timestamp <= time.time():
-                return self._eventq.pop(0)
+        @_locked
+        def _wait_for_event(self):
+            # Sleep until the earliest event is due, or until an earlier event is inserted.
+            # Because the timeout is computed with the lock held, an insertion cannot
+            # slip in unnoticed between popping and waiting.
+            if self._eventq:
+                timeout = self._eventq[0][0] - time.time()
+                if timeout > 0:
+                    self._wakeup.wait(timeout)
             else:
-                return None
+                self._wakeup.wait()
 
         def event_at(self, when, data):
             """
@@ -455,7 +664,7 @@ class Bot(_BotBase):
                         self._event_handler(e.data)
 
                     e = self._pop_expired_event()
-                time.sleep(0.1)
+                self._wait_for_event()
 
         def run_as_thread(self):
             self.daemon = True
@@ -488,6 +697,8 @@ class Bot(_BotBase):
         self._router.route(msg)
 
     def _api_request(self, method, params=None, files=None, **kwargs):
+        if files:
+            kwargs.setdefault('file_chunk_size', self._file_chunk_size)
         return api.request((self._token, method, params, files), **kwargs)
 
     def _api_request_with_file(self, method, params, file_key, file_value, **kwargs):
@@ -1043,34 +1254,143 @@ class Bot(_BotBase):
         p.update(_dismantle_message_identifier(game_message_identifier))
         return self._api_request('getGameHighScores', _rectify(p))
 
-    def download_file(self, file_id, dest):
+    def download_file(self, file_id, dest, retries=3):
         """
         Download a file to local disk.
 
         :param dest: a path or a ``file`` object
+
+        :param retries:
+            number of times to resume, from where it left off, if the connection
+            breaks in the middle of a download
         """
         f = self.getFile(file_id)
         try:
             d = dest if _isfile(dest) else open(dest, 'wb')
 
-            r = api.download((self._token, f['file_path']), preload_content=False)
+            received = 0
 
             while 1:
-                data = r.read(self._file_chunk_size)
-                if not data:
-                    break
-                d.write(data)
+                r = api.download((self._token, f['file_path']), offset=received, preload_content=False)
+                exhausted = False
+                try:
+                    # If server ignores Range and sends the whole file, skip what we have.
+                    skip = received if r.status == 200 else 0
+
+                    for chunk in r.stream(self._file_chunk_size):
+                        n = len(chunk)
+                        if skip >= n:
+                            skip -= n
+                            continue
+                        d.write(chunk[skip:] if skip else chunk)
+                        received += n - skip
+                        skip = 0
+                    exhausted = True
+                except api._resumable_errors:
+                    if retries <= 0:
+                        raise
+                else:
+                    # Response may end early without error. Resume in that case, too.
+                    if received >= f.get('file_size', received):
+                        break
+                    if retries <= 0:
+                        raise IOError('Download incomplete: %d of %d bytes' % (received, f['file_size']))
+                finally:
+                    # Only a connection whose body is fully read may go back to the pool.
+                    if exhausted:
+                        r.release_conn()
+                    else:
+                        r.close()
+
+                retries -= 1
         finally:
             if not _isfile(dest) and 'd' in locals():
                 d.close()
 
-            if 'r' in locals():
-                r.release_conn()
+    def broadcast(self, chat_ids, method='sendMessage', concurrency=8, checkpoint=None, **kwargs):
+        """
+        Send the same message to many chats.
+
+        :param chat_ids:
+            an iterable (e.g. a generator) of chat ids. To resume from a checkpoint,
+            it has to give the same chat ids in the same order.
+
+        :param method:
+            name of a method taking ``chat_id``, e.g. ``sendMessage``, ``sendPhoto``,
+            ``forwardMessage``. Files have to be given as ``file_id`` or URL.
+
+        :param concurrency: maximum number of requests in flight
+
+        :param checkpoint:
+            path of a file to record progress. If it exists, chats already done
+            in a previous run are skipped. Requests in flight when the previous
+            run stopped may be repeated.
+
+        :param kwargs: parameters of ``method`` other than ``chat_id``
+
+        :return:
+            a generator yielding ``(chat_id, result)`` as requests complete, where
+            ``result`` is either what Telegram returns or the exception raised,
+            e.g. :class:`.exception.BotWasBlockedError`. Requests are made only
+            as fast as the generator is consumed.
+
+        Requests observe the rate limiter set by :func:`telepot.api.set_rate_limiter`.
+        If none is set, a default :class:`telepot.ratelimit.RateLimiter` is used.
+        """
+        from .ratelimit import RateLimiter
+        limiter = api._rate_limiter or RateLimiter()
+
+        params = _rectify(kwargs)  # serialize once for all chats
+        progress = _Checkpoint(checkpoint)
+
+        jobs = queue.Queue()
+        results = queue.Queue()
+
+        def work():
+            while 1:
+                job = jobs.get()
+                if job is None:
+                    return
+
+                index, chat_id = job
+                try:
+                    p = dict(params, chat_id=chat_id)
+                    r = api._limited_request(limiter, (self._token, method, p, None))
+                except Exception as e:
+                    r = e
+                results.put((index, chat_id, r))
+
+        workers = [threading.Thread(target=work) for i in range(concurrency)]
+        for t in workers:
+            t.daemon = True
+            t.start()
+
+        try:
+            pending = enumerate(itertools.islice(chat_ids, progress.count, None), progress.count)
+            in_flight = 0
+
+            while 1:
+                for job in itertools.islice(pending, concurrency - in_flight):
+                    jobs.put(job)
+                    in_flight += 1
+
+                if in_flight == 0:
+                    break
+
+                index, chat_id, r = results.get()
+                in_flight -= 1
+                progress.done(index)
+
+                yield chat_id, r
+        finally:
+            progress.save()
+            for t in workers:
+                jobs.put(None)
 
     def message_loop(self, callback=None, relax=0.1,
                      timeout=20, allowed_updates=None,
                      source=None, ordered=True, maxhold=3,
-                     run_forever=False):
+                     run_forever=False, retry=None):
         """
         :deprecated: will be removed in future. Use :class:`.MessageLoop` instead.
 
@@ -1117,6 +1437,11 @@ class Bot(_BotBase):
             ``allowed_updates`` parameter supplied to :meth:`telepot.Bot.getUpdates`,
             controlling which types of updates to receive.
 
+        :type retry: :class:`telepot.retry.RetryPolicy`
+        :param retry:
+            deciding how long to wait after ``getUpdates`` fails.
+            If ``None``, a default one is used.
+
         When ``source`` is a queue, these parameters are meaningful:
 
         :type ordered: bool
@@ -1176,36 +1501,36 @@ class Bot(_BotBase):
         def get_from_telegram_server():
             offset = None  # running offset
             allowed_upd = allowed_updates
+            policy = retry or RetryPolicy()
             while 1:
+                time.sleep(policy.attempt())
                 try:
                     result = self.getUpdates(offset=offset,
                                              timeout=timeout,
                                              allowed_updates=allowed_upd)
+                except Exception as e:
+                    traceback.print_exc()
+                    time.sleep(policy.failure(e))
+                    continue
+
+                policy.success()
 
-                    # Once passed, this parameter is no longer needed.
-                    allowed_upd = None
+                # Once passed, this parameter is no longer needed.
+                allowed_upd = None
 
+                try:
                     if len(result) > 0:
                         # No sort. Trust server to give messages in correct order.
                         # Update offset to max(update_id) + 1
                         offset = max([relay_to_collector(update) for update in result]) + 1
-
-                except exception.BadHTTPResponse as e:
-                    traceback.print_exc()
-
-                    # Servers probably down. Wait longer.
-                    if e.status == 502:
-                        time.sleep(30)
                 except:
                     traceback.print_exc()
                 finally:
                     time.sleep(relax)
 
         def dictify3(data):
-            if type(data) is bytes:
-                return json.loads(data.decode('utf-8'))
-            elif type(data) is str:
-                return json.loads(data)
+            if type(data) in [bytes, str]:
+                return codec.loads(data)
             elif type(data) is dict:
                 return data
             else:
@@ -1213,7 +1538,7 @@ class Bot(_BotBase):
 
         def dictify27(data):
             if type(data) in [str, unicode]:
-                return json.loads(data)
+                return codec.loads(data)
             elif type(data) is dict:
                 return data
             else:
@@ -1233,85 +1558,17 @@ class Bot(_BotBase):
             dictify = dictify3 if sys.version_info >= (3,) else dictify27
 
             # Here is the re-ordering mechanism, ensuring in-order delivery of updates.
-            max_id = None                 # max update_id passed to callback
-            buffer = collections.deque()  # keep those updates which skip some update_id
-            qwait = None                  # how long to wait for updates,
-                                          # because buffer's content has to be returned in time.
+            buffer = _ReorderBuffer(relay_to_collector, maxhold)
 
             while 1:
                 try:
-                    data = qu.get(block=True, timeout=qwait)
-                    update = dictify(data)
-
-                    if max_id is None:
-                        # First message received, handle regardless.
-                        max_id = relay_to_collector(update)
-
-                    elif update['update_id'] == max_id + 1:
-                        # No update_id skipped, handle naturally.
-                        max_id = relay_to_collector(update)
-
-                        # clear contagious updates in buffer
-                        if len(buffer) > 0:
-                            buffer.popleft()  # first element belongs to update just received, useless now.
-                            while 1:
-                                try:
-                                    if type(buffer[0]) is dict:
-                                        max_id = relay_to_collector(buffer.popleft())  # updates that arrived earlier, handle them.
-                                    else:
-                                        break  # gap, no more contagious updates
-                                except IndexError:
-                                    break  # buffer empty
-
-                    elif update['update_id'] > max_id + 1:
-                        # Update arrives pre-maturely, insert to buffer.
-                        nbuf = len(buffer)
-                        if update['update_id'] <= max_id + nbuf:
-                            # buffer long enough, put update at position
-                            buffer[update['update_id'] - max_id - 1] = update
-                        else:
-                            # buffer too short, lengthen it
-                            expire = time.time() + maxhold
-                            for a in range(nbuf, update['update_id']-max_id-1):
-                                buffer.append(expire)  # put expiry time in gaps
-                            buffer.append(update)
-
-                    else:
-                        pass  # discard
-
+                    data = qu.get(block=True, timeout=buffer.wait_time())
+                    buffer.put(dictify(data))
                 except queue.Empty:
-                    # debug message
-                    # print('Timeout')
-
-                    # some buffer contents have to be handled
-                    # flush buffer until a non-expired time is encountered
-                    while 1:
-                        try:
-                            if type(buffer[0]) is dict:
-                                max_id = relay_to_collector(buffer.popleft())
-                            else:
-                                expire = buffer[0]
-                                if expire <= time.time():
-                                    max_id += 1
-                                    buffer.popleft()
-                                else:
-                                    break  # non-expired
-                        except IndexError:
-                            break  # buffer empty
+                    # some held updates have to be handled
+                    buffer.flush()
                 except:
                     traceback.print_exc()
-                finally:
-                    try:
-                        # don't wait longer than next expiry time
-                        qwait = buffer[0] - time.time()
-                        if qwait < 0:
-                            qwait = 0
-                    except IndexError:
-                        # buffer empty, can wait forever
-                        qwait = None
-
-                    # debug message
-                    # print ('Buffer:', str(buffer), ', To Wait:', qwait, ', Max ID:', max_id)
 
         collector_thread = threading.Thread(target=collector)
         collector_thread.daemon = True
@@ -1358,13 +1615,91 @@ class SpeakerBot(Bot):
         return ln
 
 
+class _DelegateRegistry(object):
+    # Delegates by seed, least recently used first. An entry is removed when its
+    # delegate finishes. If there are more than `maxlive`, the least recently
+    # used is evicted: dropped from here and its listeners told to stop.
+    def __init__(self, is_alive, maxlive=None):
+        self._is_alive = is_alive
+        self._maxlive = maxlive
+        self._entries = collections.OrderedDict()  # {seed: (delegate, listeners)}
+        self._lock = threading.Lock()
+        self._next_sweep = 1000
+        self.total = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, seed):
+        """ Return the live delegate for ``seed``, or ``None``. """
+        with self._lock:
+            entry = self._entries.pop(seed, None)
+            if entry is None or not self._is_alive(entry[0]):
+                return None
+            self._entries[seed] = entry  # most recently used
+            return entry[0]
+
+    def add(self, seed, delegate, listeners):
+        with self._lock:
+            # Delegates not reporting their exits are dropped here.
+            if len(self._entries) >= self._next_sweep:
+                for k in [k for k,(d,ls) in self._entries.items() if not self._is_alive(d)]:
+                    del self._entries[k]
+                self._next_sweep = max(1000, len(self._entries) * 2)
+
+            self._entries.pop(seed, None)
+            self._entries[seed] = (delegate, listeners)
+            self.total += 1
+
+            evicted = []
+            while self._maxlive is not None and len(self._entries) > self._maxlive:
+                evicted.append(self._entries.popitem(last=False)[1])
+
+        for d, listeners in evicted:
+            for ln in listeners:
+                ln._evict()
+
+    def discard(self, seed, delegate):
+        """ Remove ``seed``'s entry if it is still ``delegate``. """
+        with self._lock:
+            entry = self._entries.get(seed)
+            if entry is not None and entry[0] is delegate:
+                del self._entries[seed]
+
+
 class DelegatorBot(SpeakerBot):
-    def __init__(self, token, delegation_patterns):
+    def __init__(self, token, delegation_patterns, maxlive=None):
         """
         :param delegation_patterns: a list of (seeder, delegator) tuples.
+
+        :param maxlive:
+            maximum number of live delegates for each delegation pattern. When exceeded,
+            the least recently used delegate is evicted: its listener raises
+            :class:`.exception.StopListening`, so it goes through ``on_close()``.
+            If ``None``, no limit.
         """
         super(DelegatorBot, self).__init__(token)
-        self._delegate_records = [p+({},) for p in delegation_patterns]
+        self._delegate_records = [p+(_DelegateRegistry(lambda d: d.is_alive(), maxlive),)
+                                      for p in delegation_patterns]
+        self._creating = threading.local()
+
+    def create_listener(self):
+        ln = super(DelegatorBot, self).create_listener()
+
+        # Remember listeners created while making a delegate, to evict it later.
+        created = getattr(self._creating, 'listeners', None)
+        if created is not None:
+            created.append(ln)
+        return ln
+
+    def delegate_counts(self):
+        """
+        :return:
+            a dictionary of the number of ``live`` delegates (those having a seed),
+            and the ``total`` number ever created for a seed
+        """
+        return {'live': sum([len(r) for s,m,r in self._delegate_records]),
+                'total': sum([r.total for s,m,r in self._delegate_records])}
 
     def _startable(self, delegate):
         return ((hasattr(delegate, 'start') and inspect.ismethod(delegate.start)) and
@@ -1384,21 +1719,50 @@ class DelegatorBot(SpeakerBot):
         else:
             raise RuntimeError('Delegate does not have the required methods, is not callable, and is not a valid tuple.')
 
+    def _report_exit(self, delegate, registry, seed):
+        # Wrap a function delegate so that it removes itself from registry when done.
+        # Startable delegates cannot be wrapped; registry drops them when it finds them dead,
+        # unless they offer an exit hook, as actors do.
+        if self._startable(delegate):
+            if hasattr(delegate, '_on_exit'):
+                delegate._on_exit = lambda: registry.discard(seed, delegate)
+            return delegate
+        elif callable(delegate):
+            func, args, kwargs = delegate, (), {}
+        elif type(delegate) is tuple and self._tuple_is_valid(delegate):
+            func, args, kwargs = delegate
+        else:
+            return delegate
+
+        def run():
+            try:
+                func(*args, **kwargs)
+            finally:
+                registry.discard(seed, threading.current_thread())
+        return run
+
+    def _make_delegate(self, make_delegate, seed_tuple):
+        self._creating.listeners = []
+        try:
+            return make_delegate(seed_tuple), self._creating.listeners
+        finally:
+            self._creating.listeners = None
+
     def handle(self, msg):
         self._mic.send(msg)
 
-        for calculate_seed, make_delegate, dict in self._delegate_records:
+        for calculate_seed, make_delegate, registry in self._delegate_records:
             id = calculate_seed(msg)
 
             if id is None:
                 continue
-            elif isinstance(id, collections.Hashable):
-                if id not in dict or not dict[id].is_alive():
-                    d = make_delegate((self, msg, id))
-                    d = self._ensure_startable(d)
+            elif isinstance(id, _Hashable):
+                if registry.get(id) is None:
+                    d, listeners = self._make_delegate(make_delegate, (self, msg, id))
+                    d = self._ensure_startable(self._report_exit(d, registry, id))
 
-                    dict[id] = d
-                    dict[id].start()
+                    registry.add(id, d, listeners)
+                    d.start()
             else:
                 d = make_delegate((self, msg, id))
                 d = self._ensure_startable(d)
@@ -1,20 +1,22 @@
 import io
-import json
 import time
 import asyncio
 import traceback
+import itertools
 import collections
 from concurrent.futures._base import CancelledError
 from . import helper, api
 from .. import (
     _BotBase, flavor, _find_first_key, _isstring, _strip, _rectify,
-    _dismantle_message_identifier, _split_input_media_array
+    _dismantle_message_identifier, _split_input_media_array, _Checkpoint, _ReorderBuffer,
+    _DelegateRegistry, _Hashable
 )
 
 # Patch aiohttp for sending unicode filename
 from . import hack
 
-from .. import exception
+from .. import exception, codec
+from ..retry import RetryPolicy
 
 
 def flavor_router(routing_table):
@@ -22,6 +24,46 @@ def flavor_router(routing_table):
     return router.route
 
 
+class _Broadcast(object):
+    def __init__(self, send, chat_ids, concurrency, progress, loop):
+        self._send = send
+        self._pending_ids = enumerate(itertools.islice(chat_ids, progress.count, None), progress.count)
+        self._concurrency = concurrency
+        self._progress = progress
+        self._loop = loop
+        self._tasks = set()
+        self._ready = collections.deque()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self._ready:
+            for index, chat_id in itertools.islice(self._pending_ids, self._concurrency - len(self._tasks)):
+                self._tasks.add(self._loop.create_task(self._send(index, chat_id)))
+
+            if not self._tasks:
+                self._progress.save()
+                raise StopAsyncIteration
+
+            done, self._tasks = await asyncio.wait(self._tasks, return_when=asyncio.FIRST_COMPLETED)
+            self._ready.extend(t.result() for t in done)
+
+        index, chat_id, r = self._ready.popleft()
+        self._progress.done(index)
+        return chat_id, r
+
+    def close(self):
+        """
+        Stop sending, and save progress to checkpoint file.
+        """
+        for t in self._tasks:
+            t.cancel()
+        self._tasks = set()
+        self._pending_ids = iter([])
+        self._progress.save()
+
+
 class Bot(_BotBase):
     class Scheduler(object):
         def __init__(self, loop):
@@ -622,34 +664,93 @@ class Bot(_BotBase):
         p.update(_dismantle_message_identifier(game_message_identifier))
         return await self._api_request('getGameHighScores', _rectify(p))
 
-    async def download_file(self, file_id, dest):
+    async def download_file(self, file_id, dest, retries=3):
         """
         Download a file to local disk.
 
         :param dest: a path or a ``file`` object
+
+        :param retries:
+            number of times to resume, from where it left off, if the connection
+            breaks in the middle of a download
         """
         f = await self.getFile(file_id)
 
         try:
             d = dest if isinstance(dest, io.IOBase) else open(dest, 'wb')
 
-            session, request = api.download((self._token, f['file_path']))
+            received = 0
 
-            async with session:
-                async with request as r:
-                    while 1:
-                        chunk = await r.content.read(self._file_chunk_size)
-                        if not chunk:
-                            break
-                        d.write(chunk)
+            while 1:
+                try:
+                    async with api.download((self._token, f['file_path']), offset=received) as r:
+                        if r.status >= 400:
+                            await api._parse(r)  # raise error described in response, if any
+                            raise exception.BadHTTPResponse(r.status, await r.text(), r)
+
+                        # If server ignores Range and sends the whole file, skip what we have.
+                        skip = received if r.status == 200 else 0
+
+                        while 1:
+                            chunk = await r.content.read(self._file_chunk_size)
+                            if not chunk:
+                                break
+                            if skip >= len(chunk):
+                                skip -= len(chunk)
+                                continue
+                            d.write(memoryview(chunk)[skip:])
+                            received += len(chunk) - skip
+                            skip = 0
                         d.flush()
+                except api._resumable_errors:
+                    if retries <= 0:
+                        raise
+                else:
+                    # Response may end early without error. Resume in that case, too.
+                    if received >= f.get('file_size', received):
+                        break
+                    if retries <= 0:
+                        raise IOError('Download incomplete: %d of %d bytes' % (received, f['file_size']))
+
+                retries -= 1
         finally:
             if not isinstance(dest, io.IOBase) and 'd' in locals():
                 d.close()
 
+    def broadcast(self, chat_ids, method='sendMessage', concurrency=8, checkpoint=None, **kwargs):
+        """
+        Send the same message to many chats.
+
+        :return:
+            an asynchronous iterator yielding ``(chat_id, result)`` as requests
+            complete, where ``result`` is either what Telegram returns or the
+            exception raised, e.g. :class:`.exception.BotWasBlockedError`.
+            Requests are made only as fast as the iterator is consumed.
+            If you stop iterating early, call its ``close()`` method.
+
+        Requests observe the rate limiter set by :func:`telepot.aio.api.set_rate_limiter`.
+        If none is set, a default :class:`telepot.ratelimit.RateLimiter` is used.
+
+        Other parameters are the same as in :meth:`telepot.Bot.broadcast`.
+        """
+        from ..ratelimit import RateLimiter
+        limiter = api._rate_limiter or RateLimiter()
+
+        params = _rectify(kwargs)  # serialize once for all chats
+
+        async def send(index, chat_id):
+            try:
+                p = dict(params, chat_id=chat_id)
+                r = await api._limited_request(limiter, (self._token, method, p, None))
+            except Exception as e:
+                r = e
+            return index, chat_id, r
+
+        return _Broadcast(send, chat_ids, concurrency, _Checkpoint(checkpoint), self._loop)
+
     async def message_loop(self, handler=None, relax=0.1,
                            timeout=20, allowed_updates=None,
-                           source=None, ordered=True, maxhold=3):
+                           source=None, ordered=True, maxhold=3, retry=None):
         """
         Return a task to constantly ``getUpdates`` or pull updates from a queue.
         Apply ``handler`` to every message received.
@@ -704,6 +805,11 @@ class Bot(_BotBase):
         :param allowed_updates:
             ``allowed_updates`` parameter supplied to :meth:`telepot.aio.Bot.getUpdates`,
             controlling which types of updates to receive.
+
+        :type retry: :class:`telepot.retry.RetryPolicy`
+        :param retry:
+            deciding how long to wait after ``getUpdates`` fails.
+            If ``None``, a default one is used.
         """
         if handler is None:
             handler = self.handle
@@ -740,38 +846,35 @@ class Bot(_BotBase):
         async def get_from_telegram_server():
             offset = None  # running offset
             allowed_upd = allowed_updates
+            policy = retry or RetryPolicy()
             while 1:
+                await asyncio.sleep(policy.attempt())
                 try:
                     result = await self.getUpdates(offset=offset,
                                                    timeout=timeout,
                                                    allowed_updates=allowed_upd)
-
-                    # Once passed, this parameter is no longer needed.
-                    allowed_upd = None
-
-                    if len(result) > 0:
-                        # No sort. Trust server to give messages in correct order.
-                        # Update offset to max(update_id) + 1
-                        offset = max([handle(update) for update in result]) + 1
-                except CancelledError:
+                except (CancelledError, asyncio.CancelledError):
                     raise
-                except exception.BadHTTPResponse as e:
+                except Exception as e:
                     traceback.print_exc()
+                    await asyncio.sleep(policy.failure(e))
+                    continue
 
-                    # Servers probably down. Wait longer.
-                    if e.status == 502:
-                        await asyncio.sleep(30)
-                except:
-                    traceback.print_exc()
-                    await asyncio.sleep(relax)
-                else:
-                    await asyncio.sleep(relax)
+                policy.success()
+
+                # Once passed, this parameter is no longer needed.
+                allowed_upd = None
+
+                if len(result) > 0:
+                    # No sort. Trust server to give messages in correct order.
+                    # Update offset to max(update_id) + 1
+                    offset = max([handle(update) for update in result]) + 1
+
+                await asyncio.sleep(relax)
 
         def dictify(data):
-            if type(data) is bytes:
-                return json.loads(data.decode('utf-8'))
-            elif type(data) is str:
-                return json.loads(data)
+            if type(data) in [bytes, str]:
+                return codec.loads(data)
             elif type(data) is dict:
                 return data
             else:
@@ -788,85 +891,17 @@ class Bot(_BotBase):
 
         async def get_from_queue(qu):
             # Here is the re-ordering mechanism, ensuring in-order delivery of updates.
-            max_id = None                 # max update_id passed to callback
-            buffer = collections.deque()  # keep those updates which skip some update_id
-            qwait = None                  # how long to wait for updates,
-                                          # because buffer's content has to be returned in time.
+            buffer = _ReorderBuffer(handle, maxhold)
 
             while 1:
                 try:
-                    data = await asyncio.wait_for(qu.get(), qwait)
-                    update = dictify(data)
-
-                    if max_id is None:
-                        # First message received, handle regardless.
-                        max_id = handle(update)
-
-                    elif update['update_id'] == max_id + 1:
-                        # No update_id skipped, handle naturally.
-                        max_id = handle(update)
-
-                        # clear contagious updates in buffer
-                        if len(buffer) > 0:
-                            buffer.popleft()  # first element belongs to update just received, useless now.
-                            while 1:
-                                try:
-                                    if type(buffer[0]) is dict:
-                                        max_id = handle(buffer.popleft())  # updates that arrived earlier, handle them.
-                                    else:
-                                        break  # gap, no more contagious updates
-                                except IndexError:
-                                    break  # buffer empty
-
-                    elif update['update_id'] > max_id + 1:
-                        # Update arrives pre-maturely, insert to buffer.
-                        nbuf = len(buffer)
-                        if update['update_id'] <= max_id + nbuf:
-                            # buffer long enough, put update at position
-                            buffer[update['update_id'] - max_id - 1] = update
-                        else:
-                            # buffer too short, lengthen it
-                            expire = time.time() + maxhold
-                            for a in range(nbuf, update['update_id']-max_id-1):
-                                buffer.append(expire)  # put expiry time in gaps
-                            buffer.append(update)
-
-                    else:
-                        pass  # discard
-
+                    data = await asyncio.wait_for(qu.get(), buffer.wait_time())
+                    buffer.put(dictify(data))
                 except asyncio.TimeoutError:
-                    # debug message
-                    # print('Timeout')
-
-                    # some buffer contents have to be handled
-                    # flush buffer until a non-expired time is encountered
-                    while 1:
-                        try:
-                            if type(buffer[0]) is dict:
-                                max_id = handle(buffer.popleft())
-                            else:
-                                expire = buffer[0]
-                                if expire <= time.time():
-                                    max_id += 1
-                                    buffer.popleft()
-                                else:
-                                    break  # non-expired
-                        except IndexError:
-                            break  # buffer empty
+                    # some held updates have to be handled
+                    buffer.flush()
                 except:
                     traceback.print_exc()
-                finally:
-                    try:
-                        # don't wait longer than next expiry time
-                        qwait = buffer[0] - time.time()
-                        if qwait < 0:
-                            qwait = 0
-                    except IndexError:
-                        # buffer empty, can wait forever
-                        qwait = None
-
-                    # debug message
-                    # print ('Buffer:', str(buffer), ', To Wait:', qwait, ', Max ID:', max_id)
 
         self._scheduler._callback = callback
 
@@ -898,29 +933,61 @@ class SpeakerBot(Bot):
 
 
 class DelegatorBot(SpeakerBot):
-    def __init__(self, token, delegation_patterns, loop=None):
+    def __init__(self, token, delegation_patterns, loop=None, maxlive=None):
         """
         :param delegation_patterns: a list of (seeder, delegator) tuples.
+
+        :param maxlive:
+            maximum number of live delegates for each delegation pattern. When exceeded,
+            the least recently used delegate is evicted: its listener raises
+            :class:`.exception.StopListening`, so it goes through ``on_close()``.
+            If ``None``, no limit.
         """
         super(DelegatorBot, self).__init__(token, loop)
-        self._delegate_records = [p+({},) for p in delegation_patterns]
+        self._delegate_records = [p+(_DelegateRegistry(lambda t: not t.done(), maxlive),)
+                                      for p in delegation_patterns]
+        self._creating = None
+
+    def create_listener(self):
+        ln = super(DelegatorBot, self).create_listener()
+
+        # Remember listeners created while making a delegate, to evict it later.
+        if self._creating is not None:
+            self._creating.append(ln)
+        return ln
+
+    def delegate_counts(self):
+        """
+        :return:
+            a dictionary of the number of ``live`` delegates (those having a seed),
+            and the ``total`` number ever created for a seed
+        """
+        return {'live': sum([len(r) for s,m,r in self._delegate_records]),
+                'total': sum([r.total for s,m,r in self._delegate_records])}
 
     def handle(self, msg):
         self._mic.send(msg)
 
-        for calculate_seed, make_coroutine_obj, dict in self._delegate_records:
+        for calculate_seed, make_coroutine_obj, registry in self._delegate_records:
             id = calculate_seed(msg)
 
             if id is None:
                 continue
-            elif isinstance(id, collections.Hashable):
-                if id not in dict or dict[id].done():
-                    c = make_coroutine_obj((self, msg, id))
+            elif isinstance(id, _Hashable):
+                if registry.get(id) is None:
+                    self._creating = []
+                    try:
+                        c = make_coroutine_obj((self, msg, id))
+                        listeners = self._creating
+                    finally:
+                        self._creating = None
 
                     if not asyncio.iscoroutine(c):
                         raise RuntimeError('You must produce a coroutine *object* as delegate.')
 
-                    dict[id] = self._loop.create_task(c)
+                    task = self._loop.create_task(c)
+                    task.add_done_callback(lambda t, id=id, registry=registry: registry.discard(id, t))
+                    registry.add(id, task, listeners)
             else:
                 c = make_coroutine_obj((self, msg, id))
                 self._loop.create_task(c)
@@ -2,20 +2,40 @@ import asyncio
 import aiohttp
 import async_timeout
 import atexit
-import re
-import json
-from .. import exception
-from ..api import _methodurl, _which_pool, _fileurl, _guess_filename
+from .. import exception, codec
+from ..api import _methodurl, _which_pool, _fileurl, _guess_filename, _find_error_class
 
 _loop = asyncio.get_event_loop()
 
+_stats = {}  # pool name -> {'connections': n, 'requests': n}
+
+def _create_trace_config(name):
+    stats = _stats[name] = {'connections': 0, 'requests': 0}
+
+    async def on_request_start(session, context, params):
+        stats['requests'] += 1
+
+    async def on_connection_create_end(session, context, params):
+        stats['connections'] += 1
+
+    trace = aiohttp.TraceConfig()
+    trace.on_request_start.append(on_request_start)
+    trace.on_connection_create_end.append(on_connection_create_end)
+    return trace
+
+def _create_pool(name, limit):
+    return aiohttp.ClientSession(
+               connector=aiohttp.TCPConnector(limit=limit),
+               trace_configs=[_create_trace_config(name)],
+               loop=_loop)
+
 _pools = {
-    'default': aiohttp.ClientSession(
-                   connector=aiohttp.TCPConnector(limit=10),
-                   loop=_loop)
+    'default': _create_pool('default', 10),
+    'upload': _create_pool('upload', 4),
 }
 
 _timeout = 30
+_upload_timeout = None  # see _compose_timeout()
 _proxy = None  # (url, (username, password))
 
 def set_proxy(url, basic_auth=None):
@@ -25,6 +45,39 @@ def set_proxy(url, basic_auth=None):
     else:
         _proxy = (url, basic_auth) if basic_auth else (url,)
 
+def set_upload_pool(maxsize=4, timeout=None):
+    """
+    Configure the pool of keep-alive connections used to upload files.
+    Call it before any uploads. Uploads in progress are cut off.
+
+    :param maxsize: maximum number of connections
+    :param timeout:
+        seconds to wait for an upload to complete, including the server's response.
+        ``None`` means waiting indefinitely.
+    """
+    global _upload_timeout
+    _upload_timeout = timeout
+
+    old = _pools['upload']
+    _pools['upload'] = _create_pool('upload', maxsize)
+    _loop.create_task(old.close())
+
+def pool_stats(name='upload'):
+    """
+    :param name: ``default`` or ``upload``
+
+    :return:
+        a dictionary giving the number of ``connections`` opened and ``requests``
+        made through a pool, and ``reuse_rate``, the fraction of requests that
+        went over an existing connection (``None`` if no requests yet).
+        Counts restart when the pool is rebuilt by :func:`set_upload_pool`.
+    """
+    s = _stats[name]
+    connections, requests = s['connections'], s['requests']
+    return {'connections': connections,
+            'requests': requests,
+            'reuse_rate': (1 - connections / requests) if requests else None}
+
 def _proxy_kwargs():
     if _proxy is None or len(_proxy) == 0:
         return {}
@@ -42,11 +95,6 @@ async def _close_pools():
 
 atexit.register(lambda: _loop.create_task(_close_pools()))  # have to wrap async function
 
-def _create_onetime_pool():
-    return aiohttp.ClientSession(
-               connector=aiohttp.TCPConnector(limit=1, force_close=True),
-               loop=_loop)
-
 def _default_timeout(req, **user_kw):
     return _timeout
 
@@ -57,10 +105,10 @@ def _compose_timeout(req, **user_kw):
         # Ensure HTTP timeout is longer than getUpdates timeout
         return params['timeout'] + _default_timeout(req, **user_kw)
     elif files:
-        # Disable timeout if uploading files. For some reason, the larger the file,
+        # No timeout for uploads by default. For some reason, the larger the file,
         # the longer it takes for the server to respond (after upload is finished).
         # It is unclear how long timeout should be.
-        return None
+        return _upload_timeout
     else:
         return _default_timeout(req, **user_kw)
 
@@ -94,14 +142,8 @@ def _transform(req, **user_kw):
 
     url = _methodurl(req, **user_kw)
 
-    name = _which_pool(req, **user_kw)
-
-    if name is None:
-        session = _create_onetime_pool()
-        cleanup = session.close  # one-time session: remember to close
-    else:
-        session = _pools[name]
-        cleanup = None  # reuse: do not close
+    session = _pools[_which_pool(req, **user_kw)]
+    cleanup = None  # reuse: do not close
 
     kwargs = {'data':data}
     kwargs.update(user_kw)
@@ -110,10 +152,10 @@ def _transform(req, **user_kw):
 
 async def _parse(response):
     try:
-        data = await response.json()
+        data = codec.loads(await response.read())
         if data is None:
             raise ValueError()
-    except (ValueError, json.JSONDecodeError, aiohttp.ClientResponseError):
+    except (ValueError, aiohttp.ClientResponseError):
         text = await response.text()
         raise exception.BadHTTPResponse(response.status, text, response)
 
@@ -122,16 +164,40 @@ async def _parse(response):
     else:
         description, error_code = data['description'], data['error_code']
 
-        # Look for specific error ...
-        for e in exception.TelegramError.__subclasses__():
-            n = len(e.DESCRIPTION_PATTERNS)
-            if any(map(re.search, e.DESCRIPTION_PATTERNS, n*[description], n*[re.IGNORECASE])):
-                raise e(description, error_code, data)
+        # Look for specific error, or raise generic error
+        raise _find_error_class(description)(description, error_code, data)
+
+_rate_limiter = None
 
-        # ... or raise generic error
-        raise exception.TelegramError(description, error_code, data)
+def set_rate_limiter(limiter):
+    """
+    Make all requests wait their turn according to ``limiter``.
+
+    :param limiter: a :class:`telepot.ratelimit.RateLimiter`, or ``None`` for no limit
+    """
+    global _rate_limiter
+    _rate_limiter = limiter
 
 async def request(req, **user_kw):
+    return await _limited_request(_rate_limiter, req, **user_kw)
+
+async def _limited_request(limiter, req, **user_kw):
+    if limiter is None:
+        return await _request(req, **user_kw)
+
+    retries = limiter.retries
+    while 1:
+        delay = limiter.reserve(req)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        try:
+            return await _request(req, **user_kw)
+        except exception.TelegramError as e:
+            if retries <= 0 or not limiter.backoff(req, e):
+                raise
+            retries -= 1
+
+async def _request(req, **user_kw):
     fn, args, kwargs, timeout, cleanup = _transform(req, **user_kw)
 
     kwargs.update(_proxy_kwargs())
@@ -158,11 +224,17 @@ async def request(req, **user_kw):
             else:
                 cleanup()
 
-def download(req):
-    session = _create_onetime_pool()
+# Errors after which a download may resume from where it left off
+_resumable_errors = (aiohttp.ClientPayloadError, aiohttp.ClientConnectionError, asyncio.TimeoutError)
 
+def download(req, offset=0):
+    """
+    :param offset: if non-zero, request only bytes from ``offset`` onwards
+    """
     kwargs = {}
     kwargs.update(_proxy_kwargs())
 
-    return session, session.get(_fileurl(req), timeout=_timeout, **kwargs)
-    # Caller should close session after download is complete
+    if offset:
+        kwargs['headers'] = {'Range': 'bytes=%d-' % offset}
+
+    return _pools['default'].get(_fileurl(req), timeout=_timeout, **kwargs)
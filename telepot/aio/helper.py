@@ -1,13 +1,13 @@
 import asyncio
 import traceback
-from .. import filtering, helper, exception
+from .. import helper, exception
 from .. import (
     flavor, chat_flavors, inline_flavors, is_event,
     message_identifier, origin_identifier)
 
 # Mirror traditional version
 from ..helper import (
-    Sender, Administrator, Editor, openable,
+    Sender, Administrator, Editor, openable, HibernationStore,
     StandardEventScheduler, StandardEventMixin)
 
 
@@ -25,18 +25,9 @@ def _create_invoker(obj, method_name):
     return d
 
 
-class Microphone(object):
-    def __init__(self):
-        self._queues = set()
-
-    def add(self, q):
-        self._queues.add(q)
-
-    def remove(self, q):
-        self._queues.remove(q)
-
+class Microphone(helper.Microphone):
     def send(self, msg):
-        for q in self._queues:
+        for q in self._targets(msg):
             try:
                 q.put_nowait(msg)
             except asyncio.QueueFull:
@@ -55,7 +46,7 @@ class Listener(helper.Listener):
         while 1:
             msg = await self._queue.get()
 
-            if any(map(lambda p: filtering.match_all(msg, p), self._patterns)):
+            if self._match(msg):
                 return msg
 
 
@@ -188,6 +179,11 @@ class IdleEventCoordinator(helper.IdleEventCoordinator):
         async def augmented(msg):
             # Reset timer if this is an external message
             is_event(msg) or self.refresh()
+
+            # Let timeout event through only if idle long enough
+            if flavor(msg) == '_idle' and not self._accept_timeout(msg):
+                return
+
             return await _invoke(handler, msg)
         return augmented
 
@@ -209,6 +205,32 @@ class IdleTerminateMixin(helper.IdleTerminateMixin):
     IdleEventCoordinator = IdleEventCoordinator
 
 
+class HibernateMixin(helper.HibernateMixin):
+    # SQLite is queried in the default executor, not to hold up other chats.
+    async def _restore(self):
+        store, kind = self._hibernation()
+        self._thaw(await self.bot.loop.run_in_executor(None, store.load, kind, self.id))
+
+    async def _hibernate(self, ex):
+        fn, args = self._freeze(ex)
+        await self.bot.loop.run_in_executor(None, fn, *args)
+
+    def _augment_open(self, handler):
+        async def augmented(initial_msg, seed):
+            await self._restore()
+            return await _invoke(handler, initial_msg, seed)
+        return augmented
+
+    def _augment_on_close(self, handler):
+        async def augmented(ex):
+            try:
+                await self._hibernate(ex)
+            except:
+                traceback.print_exc()
+            return await _invoke(handler, ex)
+        return augmented
+
+
 class Router(helper.Router):
     async def route(self, msg, *aa, **kw):
         """
@@ -226,9 +248,15 @@ class Router(helper.Router):
         k = self.key_function(msg)
 
         if isinstance(k, (tuple, list)):
-            key, args, kwargs = {1: tuple(k) + ((),{}),
-                                 2: tuple(k) + ({},),
-                                 3: tuple(k),}[len(k)]
+            n = len(k)
+            if n == 2:
+                (key, args), kwargs = k, {}
+            elif n == 1:
+                key, args, kwargs = k[0], (), {}
+            elif n == 3:
+                key, args, kwargs = k
+            else:
+                raise KeyError(n)
         else:
             key, args, kwargs = k, (), {}
 
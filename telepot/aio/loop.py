@@ -1,21 +1,71 @@
 import asyncio
-import time
 import traceback
-import collections
 from concurrent.futures._base import CancelledError
 
 from . import flavor_router
 
-from ..loop import _extract_message, _dictify
-from .. import exception
+from ..loop import _extract_message, _dictify, LatencyHistogram
+from .. import _ReorderBuffer
+from ..retry import RetryPolicy
 
 
 class GetUpdatesLoop(object):
-    def __init__(self, bot, on_update):
+    def __init__(self, bot, on_update, latency=None):
+        """
+        :param latency: a :class:`.LatencyHistogram` to record into. If ``None``, a new one.
+        """
         self._bot = bot
         self._update_handler = on_update
+        self.latency = latency or LatencyHistogram()
+
+    def _dispatch(self, update):
+        self.latency.add_update(update)
+        self._update_handler(update)
+
+    async def _run_pipelined(self, offset, timeout, allowed_updates, retry):
+        def poll():
+            return self._bot.loop.create_task(
+                       self._bot.getUpdates(offset=offset,
+                                            timeout=timeout,
+                                            allowed_updates=allowed_updates))
+        pending = None
+        try:
+            while 1:
+                try:
+                    if pending is None:
+                        await asyncio.sleep(retry.attempt())
+                        pending = poll()
+
+                    result = await pending
+                    pending = None
+                    retry.success()
 
-    async def run_forever(self, relax=0.1, offset=None, timeout=20, allowed_updates=None):
+                    # Once passed, this parameter is no longer needed.
+                    allowed_updates = None
+
+                    if result:
+                        # Next poll goes out before handling these updates.
+                        offset = result[-1]['update_id'] + 1
+                        pending = poll()
+
+                        for update in result:
+                            try:
+                                self._dispatch(update)
+                            except:
+                                traceback.print_exc()
+
+                except (CancelledError, asyncio.CancelledError):
+                    raise
+                except Exception as e:
+                    traceback.print_exc()
+                    pending = None
+                    await asyncio.sleep(retry.failure(e))
+        except (CancelledError, asyncio.CancelledError):
+            if pending:
+                pending.cancel()
+
+    async def run_forever(self, relax=0.1, offset=None, timeout=20, allowed_updates=None,
+                          pipeline=False, retry=None):
         """
         Process new updates in infinity loop
 
@@ -23,35 +73,52 @@ class GetUpdatesLoop(object):
         :param offset: int
         :param timeout: int
         :param allowed_updates: bool
+        :param pipeline:
+            If ``True``, the next poll goes out before updates are handled.
+            ``relax`` has no effect then.
+
+        :param retry:
+            a :class:`telepot.retry.RetryPolicy` deciding how long to wait after
+            ``getUpdates`` fails. If ``None``, a default one is used.
         """
+        if retry is None:
+            retry = RetryPolicy()
+
+        if pipeline:
+            return await self._run_pipelined(offset, timeout, allowed_updates, retry)
+
         while 1:
             try:
-                result = await self._bot.getUpdates(offset=offset,
-                                                    timeout=timeout,
-                                                    allowed_updates=allowed_updates)
+                await asyncio.sleep(retry.attempt())
+                try:
+                    result = await self._bot.getUpdates(offset=offset,
+                                                        timeout=timeout,
+                                                        allowed_updates=allowed_updates)
+                except (CancelledError, asyncio.CancelledError):
+                    raise
+                except Exception as e:
+                    traceback.print_exc()
+                    await asyncio.sleep(retry.failure(e))
+                    continue
+
+                retry.success()
 
                 # Once passed, this parameter is no longer needed.
                 allowed_updates = None
 
-                # No sort. Trust server to give messages in correct order.
-                for update in result:
-                    self._update_handler(update)
-                    offset = update['update_id'] + 1
-
-            except CancelledError:
-                break
-            except exception.BadHTTPResponse as e:
-                traceback.print_exc()
+                try:
+                    # No sort. Trust server to give messages in correct order.
+                    for update in result:
+                        self._dispatch(update)
+                        offset = update['update_id'] + 1
+                except:
+                    traceback.print_exc()
 
-                # Servers probably down. Wait longer.
-                if e.status == 502:
-                    await asyncio.sleep(30)
-            except:
-                traceback.print_exc()
-                await asyncio.sleep(relax)
-            else:
                 await asyncio.sleep(relax)
 
+            except (CancelledError, asyncio.CancelledError):
+                break
+
 
 def _infer_handler_function(bot, h):
     if h is None:
@@ -75,11 +142,18 @@ class MessageLoop(object):
         self._bot = bot
         self._handle = _infer_handler_function(bot, handle)
         self._task = None
+        self._latency = LatencyHistogram()
+
+    @property
+    def latency(self):
+        """ A :class:`.LatencyHistogram` of updates received """
+        return self._latency
 
     async def run_forever(self, *args, **kwargs):
         updatesloop = GetUpdatesLoop(self._bot,
                                      lambda update:
-                                         self._handle(_extract_message(update)[1]))
+                                         self._handle(_extract_message(update)[1]),
+                                     latency=self._latency)
 
         self._task = self._bot.loop.create_task(updatesloop.run_forever(*args, **kwargs))
 
@@ -101,6 +175,32 @@ class Webhook(object):
         update = _dictify(data)
         self._handle(_extract_message(update)[1])
 
+    def feed_many(self, datas):
+        """
+        Feed a number of updates. An error in one does not stop the others.
+        """
+        for data in datas:
+            try:
+                self.feed(data)
+            except:
+                traceback.print_exc()
+
+    async def serve(self, host=None, port=8443, path='/', max_size=1048576, **kwargs):
+        """
+        Listen for webhook requests, without any web framework. Call
+        :meth:`run_forever` as well, to get events handled.
+
+        Every ``POST`` to ``path`` is answered *200 OK* immediately, before the
+        update is handled. Connections are kept alive, but closed
+        after 60 seconds without data. Chunked requests are not
+        supported; Telegram does not send them.
+
+        :param max_size: maximum request body size in bytes, beyond which *413* is returned
+        :param kwargs: passed to ``loop.create_server()``, e.g. ``ssl``
+        :return: an ``asyncio`` server
+        """
+        return await _serve(self, host, port, path, max_size, **kwargs)
+
 
 class OrderedWebhook(object):
     def __init__(self, bot, handle=None):
@@ -121,85 +221,170 @@ class OrderedWebhook(object):
                 return update['update_id']
 
         # Here is the re-ordering mechanism, ensuring in-order delivery of updates.
-        max_id = None                 # max update_id passed to callback
-        buffer = collections.deque()  # keep those updates which skip some update_id
-        qwait = None                  # how long to wait for updates,
-                                      # because buffer's content has to be returned in time.
+        buffer = _ReorderBuffer(extract_handle, maxhold)
 
         while 1:
             try:
-                update = await asyncio.wait_for(self._update_queue.get(), qwait)
-
-                if max_id is None:
-                    # First message received, handle regardless.
-                    max_id = extract_handle(update)
-
-                elif update['update_id'] == max_id + 1:
-                    # No update_id skipped, handle naturally.
-                    max_id = extract_handle(update)
-
-                    # clear contagious updates in buffer
-                    if len(buffer) > 0:
-                        buffer.popleft()  # first element belongs to update just received, useless now.
-                        while 1:
-                            try:
-                                if type(buffer[0]) is dict:
-                                    max_id = extract_handle(buffer.popleft())  # updates that arrived earlier, handle them.
-                                else:
-                                    break  # gap, no more contagious updates
-                            except IndexError:
-                                break  # buffer empty
-
-                elif update['update_id'] > max_id + 1:
-                    # Update arrives pre-maturely, insert to buffer.
-                    nbuf = len(buffer)
-                    if update['update_id'] <= max_id + nbuf:
-                        # buffer long enough, put update at position
-                        buffer[update['update_id'] - max_id - 1] = update
-                    else:
-                        # buffer too short, lengthen it
-                        expire = time.time() + maxhold
-                        for a in range(nbuf, update['update_id']-max_id-1):
-                            buffer.append(expire)  # put expiry time in gaps
-                        buffer.append(update)
-
-                else:
-                    pass  # discard
-
+                update = await asyncio.wait_for(self._update_queue.get(), buffer.wait_time())
+                buffer.put(update)
             except asyncio.TimeoutError:
-                # debug message
-                # print('Timeout')
-
-                # some buffer contents have to be handled
-                # flush buffer until a non-expired time is encountered
-                while 1:
-                    try:
-                        if type(buffer[0]) is dict:
-                            max_id = extract_handle(buffer.popleft())
-                        else:
-                            expire = buffer[0]
-                            if expire <= time.time():
-                                max_id += 1
-                                buffer.popleft()
-                            else:
-                                break  # non-expired
-                    except IndexError:
-                        break  # buffer empty
+                # some held updates have to be handled
+                buffer.flush()
             except:
                 traceback.print_exc()
-            finally:
-                try:
-                    # don't wait longer than next expiry time
-                    qwait = buffer[0] - time.time()
-                    if qwait < 0:
-                        qwait = 0
-                except IndexError:
-                    # buffer empty, can wait forever
-                    qwait = None
-
-                # debug message
-                # print ('Buffer:', str(buffer), ', To Wait:', qwait, ', Max ID:', max_id)
 
     def feed(self, data):
         update = _dictify(data)
         self._update_queue.put_nowait(update)
+
+    def feed_many(self, datas):
+        """
+        Feed a number of updates. An error in one does not stop the others.
+        """
+        for data in datas:
+            try:
+                self.feed(data)
+            except:
+                traceback.print_exc()
+
+    async def serve(self, host=None, port=8443, path='/', max_size=1048576, **kwargs):
+        """
+        See :meth:`Webhook.serve`.
+        """
+        return await _serve(self, host, port, path, max_size, **kwargs)
+
+
+_reasons = {
+    200: 'OK',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    411: 'Length Required',
+    413: 'Payload Too Large',
+    431: 'Request Header Fields Too Large',
+}
+
+class _WebhookProtocol(asyncio.Protocol):
+    max_header_size = 8192
+    timeout = 60  # seconds a connection may sit idle or half-sent
+
+    def __init__(self, webhook, path, max_size, loop):
+        self._webhook = webhook
+        self._path = path
+        self._max_size = max_size
+        self._loop = loop
+        self._transport = None
+        self._buffer = bytearray()
+        self._timer = None
+
+    def connection_made(self, transport):
+        self._transport = transport
+        self._reset_timer()
+
+    def connection_lost(self, exc):
+        self._transport = None
+        self._cancel_timer()
+
+    def _reset_timer(self):
+        self._cancel_timer()
+        self._timer = self._loop.call_later(self.timeout, self._on_timeout)
+
+    def _cancel_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _on_timeout(self):
+        self._timer = None
+        if self._transport:
+            self._transport.close()
+            self._transport = None
+
+    def data_received(self, data):
+        self._reset_timer()
+        self._buffer += data
+
+        # Answer all complete requests, then hand their bodies over in one go.
+        bodies = []
+        while self._transport and self._next_request(bodies):
+            pass
+
+        if bodies:
+            self._loop.call_soon(self._webhook.feed_many, bodies)
+
+    def _respond(self, status, keep_alive=True, headers=''):
+        self._transport.write(('HTTP/1.1 %d %s\r\nContent-Length: 0\r\n%s%s\r\n' % (
+                                  status, _reasons[status], headers,
+                                  '' if keep_alive else 'Connection: close\r\n')).encode('latin-1'))
+        if not keep_alive:
+            self._transport.close()
+            self._transport = None
+
+    def _next_request(self, bodies):
+        # Return True if a request is consumed from buffer, False if more data is needed.
+        buffer = self._buffer
+
+        end = buffer.find(b'\r\n\r\n')
+        if end < 0:
+            if len(buffer) > self.max_header_size:
+                self._respond(431, keep_alive=False)
+            return False
+
+        lines = buffer[:end].decode('latin-1').split('\r\n')
+
+        try:
+            method, target, version = lines[0].split(' ')
+            headers = {}
+            for line in lines[1:]:
+                name, value = line.split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+        except ValueError:
+            self._respond(400, keep_alive=False)
+            return False
+
+        # Only plain digits: int() would also take '-3', '+5', ' 5' and '1_000'.
+        length = headers.get('content-length', '0')
+        try:
+            if not length.isdigit():
+                raise ValueError(length)
+            length = int(length)  # isdigit() passes '\xb2', which int() rejects
+        except ValueError:
+            self._respond(400, keep_alive=False)
+            return False
+
+        if 'transfer-encoding' in headers:
+            self._respond(411, keep_alive=False)
+            return False
+
+        if length > self._max_size:
+            self._respond(413, keep_alive=False)
+            return False
+
+        start = end + 4
+        if len(buffer) < start + length:
+            return False
+
+        body = bytes(buffer[start:start+length])
+        del buffer[:start+length]
+
+        connection = headers.get('connection', '').lower()
+        if version == 'HTTP/1.0':
+            keep_alive = connection == 'keep-alive'
+        else:
+            keep_alive = connection != 'close'
+
+        if target.split('?', 1)[0] != self._path:
+            self._respond(404, keep_alive)
+        elif method != 'POST':
+            self._respond(405, keep_alive, 'Allow: POST\r\n')
+        else:
+            self._respond(200, keep_alive)
+            bodies.append(body)
+
+        return True
+
+async def _serve(webhook, host, port, path, max_size, **kwargs):
+    loop = webhook._bot.loop
+    return await loop.create_server(
+               lambda: _WebhookProtocol(webhook, path, max_size, loop),
+               host, port, **kwargs)
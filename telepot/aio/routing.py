@@ -3,7 +3,7 @@ from .. import all_content_types
 
 # Mirror traditional version to avoid having to import one more module
 from ..routing import (
-    by_content_type, by_command, by_chat_command, by_text, by_data, by_regex,
+    by_content_type, by_command, by_chat_command, by_text, by_data, by_regex, by_regexes,
     process_key, lower_key, upper_key
 )
 
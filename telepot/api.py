@@ -1,24 +1,40 @@
 import urllib3
+import urllib3.exceptions
+import urllib3.fields
+import urllib3.filepost
 import logging
-import json
 import re
 import os
+import stat
+import socket
+import time
 
-from . import exception, _isstring
+from . import exception, codec, _isstring
 
 # Suppress InsecurePlatformWarning
 urllib3.disable_warnings()
 
 
 _default_pool_params = dict(num_pools=3, maxsize=10, retries=3, timeout=30)
-_onetime_pool_params = dict(num_pools=1, maxsize=1, retries=3, timeout=30)
+
+# Uploads keep their connections alive, like other requests. But read timeout
+# is disabled. For some reason, the larger the file, the longer it takes for
+# the server to respond (after upload is finished). It is unclear how long
+# timeout should be.
+_upload_pool_params = dict(num_pools=1, maxsize=4, retries=3,
+                           timeout=urllib3.Timeout(connect=30, read=None))
+
+_pool_spec = (urllib3.PoolManager, {})  # pool class, arguments other than pool params
+
+def _create_pool(params):
+    cls, kw = _pool_spec
+    return cls(**dict(kw, **params))
 
 _pools = {
-    'default': urllib3.PoolManager(**_default_pool_params),
+    'default': _create_pool(_default_pool_params),
+    'upload': _create_pool(_upload_pool_params),
 }
 
-_onetime_pool_spec = (urllib3.PoolManager, _onetime_pool_params)
-
 
 def set_proxy(url, basic_auth=None):
     """
@@ -27,21 +43,55 @@ def set_proxy(url, basic_auth=None):
     :param url: proxy URL
     :param basic_auth: 2-tuple ``('username', 'password')``
     """
-    global _pools, _onetime_pool_spec
+    global _pool_spec
     if not url:
-        _pools['default'] = urllib3.PoolManager(**_default_pool_params)
-        _onetime_pool_spec = (urllib3.PoolManager, _onetime_pool_params)
+        _pool_spec = (urllib3.PoolManager, {})
     elif basic_auth:
         h = urllib3.make_headers(proxy_basic_auth=':'.join(basic_auth))
-        _pools['default'] = urllib3.ProxyManager(url, proxy_headers=h, **_default_pool_params)
-        _onetime_pool_spec = (urllib3.ProxyManager, dict(proxy_url=url, proxy_headers=h, **_onetime_pool_params))
+        _pool_spec = (urllib3.ProxyManager, dict(proxy_url=url, proxy_headers=h))
     else:
-        _pools['default'] = urllib3.ProxyManager(url, **_default_pool_params)
-        _onetime_pool_spec = (urllib3.ProxyManager, dict(proxy_url=url, **_onetime_pool_params))
+        _pool_spec = (urllib3.ProxyManager, dict(proxy_url=url))
 
-def _create_onetime_pool():
-    cls, kw = _onetime_pool_spec
-    return cls(**kw)
+    _pools['default'] = _create_pool(_default_pool_params)
+    _pools['upload'] = _create_pool(_upload_pool_params)
+
+def set_upload_pool(maxsize=4, connect_timeout=30, read_timeout=None):
+    """
+    Configure the pool of keep-alive connections used to upload files.
+
+    :param maxsize: maximum number of connections kept alive
+    :param connect_timeout: seconds to wait for a connection to be established
+    :param read_timeout:
+        seconds to wait for the server's response. ``None`` means waiting indefinitely.
+    """
+    global _upload_pool_params
+    _upload_pool_params = dict(_upload_pool_params,
+                               maxsize=maxsize,
+                               timeout=urllib3.Timeout(connect=connect_timeout, read=read_timeout))
+    _pools['upload'] = _create_pool(_upload_pool_params)
+
+def pool_stats(name='upload'):
+    """
+    :param name: ``default`` or ``upload``
+
+    :return:
+        a dictionary giving the number of ``connections`` opened and ``requests``
+        made through a pool, and ``reuse_rate``, the fraction of requests that
+        went over an existing connection (``None`` if no requests yet).
+        Counts restart when the pool is rebuilt by :func:`set_proxy` or
+        :func:`set_upload_pool`.
+    """
+    manager = _pools[name]
+    connections = requests = 0
+    for key in manager.pools.keys():
+        p = manager.pools.get(key)
+        if p is not None:
+            connections += p.num_connections
+            requests += p.num_requests
+
+    return {'connections': connections,
+            'requests': requests,
+            'reuse_rate': (1 - float(connections) / requests) if requests else None}
 
 def _methodurl(req, **user_kw):
     token, method, params, files = req
@@ -49,7 +99,7 @@ def _methodurl(req, **user_kw):
 
 def _which_pool(req, **user_kw):
     token, method, params, files = req
-    return None if files else 'default'
+    return 'upload' if files else 'default'
 
 def _guess_filename(obj):
     name = getattr(obj, 'name', None)
@@ -58,13 +108,11 @@ def _guess_filename(obj):
 
 def _filetuple(key, f):
     if not isinstance(f, tuple):
-        return (_guess_filename(f) or key, f.read())
+        return (_guess_filename(f) or key, f)
     elif len(f) == 1:
-        return (_guess_filename(f[0]) or key, f[0].read())
-    elif len(f) == 2:
-        return (f[0], f[1].read())
-    elif len(f) == 3:
-        return (f[0], f[1].read(), f[2])
+        return (_guess_filename(f[0]) or key, f[0])
+    elif len(f) in [2, 3]:
+        return f
     else:
         raise ValueError()
 
@@ -85,12 +133,128 @@ def _compose_fields(req, **user_kw):
 
     return fields
 
+def _remaining_length(f):
+    # Number of bytes from current position to end of file, or None if unknown.
+    try:
+        start = f.tell()
+    except (AttributeError, IOError, OSError, ValueError):
+        return None, None
+
+    try:
+        st = os.fstat(f.fileno())
+        if stat.S_ISREG(st.st_mode):
+            return start, st.st_size - start
+    except (AttributeError, IOError, OSError, ValueError):
+        pass
+
+    try:
+        f.seek(0, 2)
+        end = f.tell()
+        f.seek(start)
+        return start, end - start
+    except (AttributeError, IOError, OSError, ValueError):
+        return None, None
+
+class _MultipartBody(object):
+    """
+    A file-like ``multipart/form-data`` body. Files are read in chunks as the
+    body is sent, so they are never loaded into memory all at once.
+
+    Files may be file objects (including ``mmap`` objects) or bytes-like objects.
+    A file whose length cannot be determined is read into memory.
+    """
+    def __init__(self, fields, chunk_size):
+        self.boundary = urllib3.filepost.choose_boundary()
+        self.content_type = 'multipart/form-data; boundary=%s' % self.boundary
+        self._chunk_size = chunk_size
+        self._parts = []  # bytes, memoryview, or (file object, start position, length)
+
+        for name, value in fields.items():
+            self._add(name, value)
+        self._parts.append(('--%s--\r\n' % self.boundary).encode('latin-1'))
+
+        self.length = sum(p[2] if isinstance(p, tuple) else len(p) for p in self._parts)
+        self.seek(0)
+
+    def _add(self, name, value):
+        if isinstance(value, tuple):
+            # Render headers from a placeholder, stream data separately.
+            filename, data = value[:2]
+            field = urllib3.fields.RequestField.from_tuples(name, (filename, b'') + value[2:])
+        else:
+            data = value
+            field = urllib3.fields.RequestField.from_tuples(name, value)
+
+        self._parts.append(('--%s\r\n' % self.boundary).encode('latin-1')
+                           + field.render_headers().encode('utf-8'))
+
+        if isinstance(data, int):
+            data = str(data)
+
+        if _isstring(data) and not isinstance(data, bytes):
+            self._parts.append(data.encode('utf-8'))
+        elif hasattr(data, 'read'):
+            start, length = _remaining_length(data)
+            if length is None:
+                self._parts.append(data.read())
+            else:
+                self._parts.append((data, start, length))
+        else:
+            self._parts.append(memoryview(data))
+
+        self._parts.append(b'\r\n')
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            chunks = []
+            while 1:
+                data = self.read(self._chunk_size)
+                if not data:
+                    return b''.join(chunks)
+                chunks.append(data)
+        elif size == 0:
+            return b''
+
+        while self._index < len(self._parts):
+            part = self._parts[self._index]
+
+            if isinstance(part, tuple):
+                f, start, length = part
+                if self._offset == 0:
+                    f.seek(start)
+                n = min(size, self._chunk_size, length - self._offset)
+                data = f.read(n) if n > 0 else b''
+                if not data and self._offset < length:
+                    raise IOError('File ended %d bytes short of its length' % (length - self._offset))
+            else:
+                data = part[self._offset:self._offset+size]
+                if isinstance(data, memoryview):
+                    data = data.tobytes()
+
+            if data:
+                self._offset += len(data)
+                self._position += len(data)
+                return data
+
+            self._index += 1
+            self._offset = 0
+
+        return b''
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=0):
+        # Only rewinding is supported, enough for retries.
+        if offset != 0 or whence != 0:
+            raise IOError('Multipart body can only be rewound to the start')
+        self._index = 0
+        self._offset = 0
+        self._position = 0
+
 def _default_timeout(req, **user_kw):
     name = _which_pool(req, **user_kw)
-    if name is None:
-        return _onetime_pool_spec[1]['timeout']
-    else:
-        return _pools[name].connection_pool_kw['timeout']
+    return _pools[name].connection_pool_kw['timeout']
 
 def _compose_kwargs(req, **user_kw):
     token, method, params, files = req
@@ -102,63 +266,170 @@ def _compose_kwargs(req, **user_kw):
     if method == 'getUpdates' and params and 'timeout' in params:
         # Ensure HTTP timeout is longer than getUpdates timeout
         kw['timeout'] = params['timeout'] + _default_timeout(req, **user_kw)
-    elif files:
-        # Disable timeout if uploading files. For some reason, the larger the file,
-        # the longer it takes for the server to respond (after upload is finished).
-        # It is unclear how long timeout should be.
-        kw['timeout'] = None
 
     # Let user-supplied arguments override
     kw.update(user_kw)
     return kw
 
+_file_chunk_size = 65536
+
 def _transform(req, **user_kw):
+    token, method, params, files = req
+
+    file_chunk_size = user_kw.pop('file_chunk_size', _file_chunk_size)
+
     kwargs = _compose_kwargs(req, **user_kw)
 
     fields = _compose_fields(req, **user_kw)
 
     url = _methodurl(req, **user_kw)
 
-    name = _which_pool(req, **user_kw)
+    pool = _pools[_which_pool(req, **user_kw)]
+
+    if files:
+        # Stream files instead of encoding the whole body in memory.
+        body = _MultipartBody(fields, file_chunk_size)
+
+        headers = {'Content-Type': body.content_type,
+                   'Content-Length': str(body.length)}
+        headers.update(kwargs.pop('headers', {}))
 
-    if name is None:
-        pool = _create_onetime_pool()
+        kwargs.update(body=body, headers=headers)
+        return pool.urlopen, ('POST', url), kwargs
     else:
-        pool = _pools[name]
+        return pool.request_encode_body, ('POST', url, fields), kwargs
 
-    return pool.request_encode_body, ('POST', url, fields), kwargs
+def _compile_error_classifier(classes):
+    # Combine all patterns into one regex. Each class contributes an alternative
+    # that looks ahead for any of its patterns, then marks itself with an empty
+    # named group. Alternatives are tried in order, so the first matching class
+    # wins, same as checking classes one by one.
+    candidates = [(e, e.DESCRIPTION_PATTERNS) for e in classes if getattr(e, 'DESCRIPTION_PATTERNS', None)]
+
+    try:
+        if any(re.search(r'\\[1-9]', p) for e, patterns in candidates for p in patterns):
+            raise re.error('numbered backreference')  # numbering would shift when combined
+
+        alternatives = ['(?=[\\s\\S]*?(?:%s))(?P<e%d>)' % ('|'.join(['(?:%s)' % p for p in patterns]), i)
+                            for i, (e, patterns) in enumerate(candidates)]
+
+        combined = re.compile('|'.join(alternatives), re.IGNORECASE)
+
+        def classify(description):
+            m = combined.match(description)
+            if m and m.lastgroup:
+                return candidates[int(m.lastgroup[1:])][0]
+            return None
+
+    # Some patterns cannot be combined. Compile them separately.
+    except re.error:
+        compiled = [(e, [re.compile(p, re.IGNORECASE) for p in patterns]) for e, patterns in candidates]
+
+        def classify(description):
+            for e, regexes in compiled:
+                if any(r.search(description) for r in regexes):
+                    return e
+            return None
+
+    return classify
+
+_error_classifier = (None, None)
+
+def _find_error_class(description):
+    """
+    Return the :class:`.TelegramError` subclass whose ``DESCRIPTION_PATTERNS``
+    match ``description``, or :class:`.TelegramError` itself if none matches.
+    """
+    global _error_classifier
+
+    # Recompile if subclasses have been added since last time.
+    classes = exception.TelegramError.__subclasses__()
+    known, classify = _error_classifier
+    if classes != known:
+        classify = _compile_error_classifier(classes)
+        _error_classifier = (classes, classify)
+
+    return classify(description) or exception.TelegramError
 
 def _parse(response):
     try:
-        text = response.data.decode('utf-8')
-        data = json.loads(text)
+        data = codec.loads(response.data)
     except ValueError:  # No JSON object could be decoded
-        raise exception.BadHTTPResponse(response.status, text, response)
+        raise exception.BadHTTPResponse(response.status, response.data.decode('utf-8', 'replace'), response)
 
     if data['ok']:
         return data['result']
     else:
         description, error_code = data['description'], data['error_code']
 
-        # Look for specific error ...
-        for e in exception.TelegramError.__subclasses__():
-            n = len(e.DESCRIPTION_PATTERNS)
-            if any(map(re.search, e.DESCRIPTION_PATTERNS, n*[description], n*[re.IGNORECASE])):
-                raise e(description, error_code, data)
+        # Look for specific error, or raise generic error
+        raise _find_error_class(description)(description, error_code, data)
 
-        # ... or raise generic error
-        raise exception.TelegramError(description, error_code, data)
+_rate_limiter = None
 
-def request(req, **user_kw):
+def set_rate_limiter(limiter):
+    """
+    Make all requests wait their turn according to ``limiter``.
+
+    :param limiter: a :class:`telepot.ratelimit.RateLimiter`, or ``None`` for no limit
+    """
+    global _rate_limiter
+    _rate_limiter = limiter
+
+def _request(req, **user_kw):
     fn, args, kwargs = _transform(req, **user_kw)
     r = fn(*args, **kwargs)  # `fn` must be thread-safe
     return _parse(r)
 
+def request(req, **user_kw):
+    return _limited_request(_rate_limiter, req, **user_kw)
+
+def _limited_request(limiter, req, **user_kw):
+    if limiter is None:
+        return _request(req, **user_kw)
+
+    retries = limiter.retries
+    while 1:
+        delay = limiter.reserve(req)
+        if delay > 0:
+            time.sleep(delay)
+        try:
+            return _request(req, **user_kw)
+        except exception.TelegramError as e:
+            if retries <= 0 or not limiter.backoff(req, e):
+                raise
+            retries -= 1
+
 def _fileurl(req):
     token, path = req
     return 'https://api.telegram.org/file/bot%s/%s' % (token, path)
 
-def download(req, **user_kw):
-    pool = _create_onetime_pool()
-    r = pool.request('GET', _fileurl(req), **user_kw)
+try:
+    import http.client as httplib
+    _connection_errors = (ConnectionError, socket.timeout)
+except ImportError:
+    import httplib
+    _connection_errors = (socket.error,)
+
+# Errors after which a download may resume from where it left off
+_resumable_errors = (urllib3.exceptions.ProtocolError,
+                     urllib3.exceptions.ReadTimeoutError,
+                     httplib.IncompleteRead) + _connection_errors
+
+def download(req, offset=0, **user_kw):
+    """
+    :param offset: if non-zero, request only bytes from ``offset`` onwards
+    """
+    if offset:
+        user_kw['headers'] = dict(user_kw.get('headers', {}), Range='bytes=%d-' % offset)
+
+    r = _pools['default'].request('GET', _fileurl(req), **user_kw)
+
+    if r.status >= 400:
+        try:
+            _parse(r)  # raise error described in response, if any
+        finally:
+            r.release_conn()
+        raise exception.BadHTTPResponse(r.status, r.data.decode('utf-8', 'replace'), r)
+
     return r
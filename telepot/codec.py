@@ -0,0 +1,99 @@
+"""
+JSON encoding and decoding for requests, responses and webhook updates.
+
+At import, the fastest library available is chosen, in this order:
+`orjson <https://github.com/ijl/orjson>`_, `ujson <https://github.com/ultrajson/ultrajson>`_,
+`simplejson <https://github.com/simplejson/simplejson>`_, and the standard
+``json`` module. Use :func:`set_backend` to choose one explicitly.
+"""
+
+import json
+
+def _stdlib_codec():
+    def loads(data):
+        # `json.loads()` does not take bytes before Python 3.6, and is slower
+        # on bytes after that. Decode first.
+        if type(data) is bytes and bytes is not str:
+            data = data.decode('utf-8')
+        return json.loads(data)
+
+    def dumps(obj):
+        return json.dumps(obj, separators=(',',':'))
+
+    return loads, dumps
+
+def _orjson_codec():
+    import orjson
+
+    def dumps(obj):
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+        except TypeError:
+            # e.g. integers beyond 64 bits
+            return json.dumps(obj, separators=(',',':'))
+
+    return orjson.loads, dumps
+
+def _ujson_codec():
+    import ujson
+
+    def dumps(obj):
+        return ujson.dumps(obj, escape_forward_slashes=False)
+
+    return ujson.loads, dumps
+
+def _simplejson_codec():
+    import simplejson
+
+    def dumps(obj):
+        return simplejson.dumps(obj, separators=(',',':'))
+
+    return simplejson.loads, dumps
+
+_codecs = [
+    ('orjson', _orjson_codec),
+    ('ujson', _ujson_codec),
+    ('simplejson', _simplejson_codec),
+    ('json', _stdlib_codec),
+]
+
+backend = None
+_loads, _dumps = None, None
+
+def loads(data):
+    """
+    Deserialize ``data`` (``bytes`` or ``str``) to a Python object.
+    Raise ``ValueError`` if it is not valid JSON.
+    """
+    return _loads(data)
+
+def dumps(obj):
+    """
+    Serialize ``obj`` to a compact JSON ``str``.
+    """
+    return _dumps(obj)
+
+def set_backend(name=None):
+    """
+    Choose the JSON library to use.
+
+    :param name:
+        ``orjson``, ``ujson``, ``simplejson``, or ``json``.
+        If ``None``, the first importable one in that order is used.
+    """
+    global backend, _loads, _dumps
+
+    for n, make_codec in _codecs:
+        if name is not None and n != name:
+            continue
+        try:
+            _loads, _dumps = make_codec()
+            backend = n
+            return
+        except ImportError:
+            if name is not None:
+                raise
+
+    raise ValueError('Unknown JSON backend: %s' % name)
+
+set_backend()
@@ -1,8 +1,14 @@
 import traceback
+import threading
 from functools import wraps
 from . import exception
 from . import flavor, peel, is_event, chat_flavors, inline_flavors
 
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
 def _wrap_none(fn):
     def w(*args, **kwargs):
         try:
@@ -282,6 +288,175 @@ def create_open(cls, *args, **kwargs):
         return wait_loop
     return f
 
+class _Mailbox(queue.Queue):
+    # A listener's queue that wakes up its actor on every message
+    def __init__(self, actor):
+        queue.Queue.__init__(self)
+        self._actor = actor
+
+    def put(self, item, block=True, timeout=None):
+        queue.Queue.put(self, item, block, timeout)
+        self._actor._notify()
+
+
+class _ActorPool(object):
+    def __init__(self, workers):
+        self._runnable = queue.Queue()
+        self._workers = workers
+        self._lock = threading.Lock()
+        self._stopped = False
+
+        for i in range(workers):
+            t = threading.Thread(target=self._work)
+            t.daemon = True
+            t.start()
+
+    def submit(self, actor):
+        with self._lock:
+            if not self._stopped:
+                self._runnable.put(actor)
+                return
+
+        # Actors created before the pool was replaced carry on in the new one.
+        _get_actor_pool().submit(actor)
+
+    def shutdown(self):
+        # Workers finish what is already queued, then exit on the sentinel.
+        with self._lock:
+            self._stopped = True
+            for i in range(self._workers):
+                self._runnable.put(None)
+
+    def _work(self):
+        while 1:
+            actor = self._runnable.get()
+            if actor is None:
+                return
+            try:
+                actor._run()
+            except:
+                traceback.print_exc()
+
+
+class _Actor(object):
+    # Drive an openable object by messages arriving in its mailbox, instead of
+    # a thread blocking on `listener.wait()`. An actor is run by at most one
+    # worker at a time, so its messages are handled one by one, in order.
+    batch = 20  # messages handled before giving other actors a turn
+
+    def __init__(self, j, seed_tuple, pool):
+        self._j = j
+        self._seed_tuple = seed_tuple
+        self._pool = pool
+        self._lock = threading.Lock()
+        self._scheduled = False
+        self._closed = False
+        self._on_exit = None  # set by DelegatorBot to leave its registry
+        self._mailbox = _Mailbox(self)
+        j.listener._move_to(self._mailbox)
+
+    def start(self):
+        self._notify()
+
+    def is_alive(self):
+        return not self._closed
+
+    def _notify(self):
+        with self._lock:
+            if self._scheduled or self._closed:
+                return
+            self._scheduled = True
+        self._pool.submit(self)
+
+    def _run(self):
+        j = self._j
+        try:
+            if self._seed_tuple:
+                bot, msg, seed = self._seed_tuple
+                self._seed_tuple = None
+
+                handled = j.open(msg, seed)
+                if not handled:
+                    j.on_message(msg)
+
+            for i in range(self.batch):
+                try:
+                    msg = self._mailbox.get_nowait()
+                except queue.Empty:
+                    break
+                if j.listener._match(msg):
+                    j.on_message(msg)
+
+        # These exceptions are "normal" exits.
+        except (exception.IdleTerminate, exception.StopListening) as e:
+            self._close(e)
+
+        # Any other exceptions are accidents. **Print it out.**
+        except Exception as e:
+            traceback.print_exc()
+            self._close(e)
+
+        with self._lock:
+            if self._closed or self._mailbox.empty():
+                self._scheduled = False
+                return
+        self._pool.submit(self)
+
+    def _close(self, e):
+        self._closed = True
+
+        # Mailbox refers to this actor. Stop microphone from holding on to both.
+        listener = self._j.listener
+        listener._mic.remove(listener._queue)
+
+        j, self._j = self._j, None
+        try:
+            j.on_close(e)
+        finally:
+            if self._on_exit:
+                self._on_exit()
+
+
+_actor_pool = None
+_actor_workers = 4
+_actor_pool_lock = threading.Lock()
+
+def set_actor_pool(workers=4):
+    """
+    Set the number of worker threads running delegates created by :func:`create_actor`.
+    Workers of the old pool exit once they have run what is queued; live actors
+    move to the new pool.
+    """
+    global _actor_pool, _actor_workers
+    with _actor_pool_lock:
+        old, _actor_pool = _actor_pool, None
+        _actor_workers = workers
+
+    if old is not None:
+        old.shutdown()
+
+def _get_actor_pool():
+    global _actor_pool
+    with _actor_pool_lock:
+        if _actor_pool is None:
+            _actor_pool = _ActorPool(_actor_workers)
+        return _actor_pool
+
+def create_actor(cls, *args, **kwargs):
+    """
+    :return:
+        a delegator function like :func:`create_open`, except that no thread is
+        spawned for each delegate. Instead, ``open``, ``on_message``, and ``on_close``
+        are invoked by a fixed pool of worker threads (see :func:`set_actor_pool`)
+        as messages arrive, one message at a time for each delegate. Thousands of
+        delegates can be live without thousands of threads. Those methods should
+        not block, and must not call ``listener.wait()``.
+    """
+    def f(seed_tuple):
+        j = cls(seed_tuple, *args, **kwargs)
+        return _Actor(j, seed_tuple, _get_actor_pool())
+    return f
+
 def until(condition, fns):
     """
     Try a list of seeder functions until a condition is met.
@@ -32,3 +32,117 @@ def match(data, template):
 
 def match_all(msg, templates):
     return all(map(lambda t: match(msg, t), templates))
+
+def compile_template(template):
+    """
+    Return a function that takes one argument (the data) and returns the same
+    result as ``match(data, template)``. The template is analyzed only once,
+    so the function is much faster when applied repeatedly.
+    """
+    if isinstance(template, dict):
+        return _compile_dict(template)
+    elif callable(template):
+        return template
+    else:
+        return lambda data: data == template
+
+def _compile_dict(template):
+    constants = []  # (key, value) to be compared directly, no nested matching
+    checks = []     # functions to be applied to the entire data
+
+    for template_key, template_value in template.items():
+        if hasattr(template_key, 'search'):  # regex
+            checks.append(_compile_regex_key(template_key, compile_template(template_value)))
+        elif isinstance(template_value, dict) or callable(template_value):
+            checks.append(_compile_constant_key(template_key, compile_template(template_value)))
+        else:
+            constants.append((template_key, template_value))
+
+    def m(data):
+        if not isinstance(data, dict):
+            return data == template
+
+        for k, v in constants:
+            if k not in data or not data[k] == v:
+                return False
+
+        for check in checks:
+            if not check(data):
+                return False
+
+        return True
+    return m
+
+def _compile_constant_key(key, match_value):
+    def check(data):
+        return key in data and bool(match_value(data[key]))
+    return check
+
+def _compile_regex_key(regex, match_value):
+    def check(data):
+        for k in data:
+            if regex.search(k) and match_value(data[k]):
+                return True
+        return False
+    return check
+
+def compile_templates(templates):
+    """
+    Return a function that takes one argument (the message) and returns the same
+    result as ``match_all(msg, templates)``.
+    """
+    matchers = [compile_template(t) for t in templates]
+
+    def m(msg):
+        for match_template in matchers:
+            if not match_template(msg):
+                return False
+        return True
+    return m
+
+def find_constraints(templates):
+    """
+    Look for parts of ``templates`` requiring a constant value at a fixed
+    place in the message (e.g. ``{'chat': {'id': 123}}``).
+
+    :return:
+        a list of 2-tuples ``(path, value)``, where ``path`` is a tuple of keys
+        (strings or regular expressions) leading to ``value``. A message not
+        having ``value`` at ``path`` cannot match ``templates``.
+    """
+    found = []
+
+    def find(template, path):
+        for k, v in template.items():
+            if isinstance(v, dict):
+                find(v, path + (k,))
+            elif not callable(v):
+                try:
+                    hash(v)
+                except TypeError:
+                    continue
+                found.append((path + (k,), v))
+
+    for t in templates:
+        if isinstance(t, dict):
+            find(t, ())
+    return found
+
+def pluck(data, path):
+    """
+    :return:
+        a list of values at ``path`` in ``data``, as given by :func:`find_constraints`.
+        A regular expression in ``path`` selects all keys it matches.
+    """
+    values = [data]
+    for k in path:
+        selected = []
+        for d in values:
+            if not isinstance(d, dict):
+                continue
+            if hasattr(k, 'search'):  # regex
+                selected.extend([d[dk] for dk in d if k.search(dk)])
+            elif k in d:
+                selected.append(d[k])
+        values = selected
+    return values
@@ -5,11 +5,14 @@ import logging
 import collections
 import re
 import inspect
+import pickle
+import sqlite3
+import weakref
 from functools import partial
 from . import filtering, exception
 from . import (
     flavor, chat_flavors, inline_flavors, is_event,
-    message_identifier, origin_identifier)
+    message_identifier, origin_identifier, Prepared)
 
 try:
     import Queue as queue
@@ -18,8 +21,18 @@ except ImportError:
 
 
 class Microphone(object):
+    """
+    Deliver messages to listeners' queues.
+
+    A queue added with no constraints receives every message. Otherwise, it
+    receives only messages satisfying at least one of its constraints, looked
+    up in an index, so sending a message costs little regardless of how many
+    queues are waiting for other chats or users.
+    """
     def __init__(self):
-        self._queues = set()
+        self._queues = set()  # no constraints, receive everything
+        self._index = {}      # {path: {value: set of queues}}
+        self._constraints = {}
         self._lock = threading.Lock()
 
     def _locked(func):
@@ -28,28 +41,94 @@ class Microphone(object):
                 return func(self, *args, **kwargs)
         return k
 
+    def _discard(self, q):
+        self._queues.discard(q)
+
+        for path, value in set(self._constraints.pop(q, ())):
+            table = self._index[path]
+            qs = table[value]
+            qs.discard(q)
+            if not qs:
+                del table[value]
+                if not table:
+                    del self._index[path]
+
+    def _choose(self, candidates):
+        # Prefer the value shared by the fewest queues, then a path already
+        # being looked up for every message.
+        def cost(c):
+            path, value = c
+            table = self._index.get(path)
+            if table is None:
+                return 0, 1
+            return len(table.get(value, ())), 0
+
+        return min(candidates, key=cost)
+
     @_locked
-    def add(self, q):
-        self._queues.add(q)
+    def add(self, q, constraints=None):
+        """
+        :param constraints:
+            a list, one item per pattern, of lists of ``(path, value)`` tuples
+            (as returned by :func:`.filtering.find_constraints`). One of each
+            is used to deliver messages possibly matching that pattern.
+            If ``None``, the queue receives every message.
+        """
+        self._discard(q)
+
+        if constraints is None:
+            self._insert(q, None)
+        else:
+            self._insert(q, [self._choose(c) for c in constraints])
+
+    def _insert(self, q, chosen):
+        if chosen is None:
+            self._queues.add(q)
+        else:
+            self._constraints[q] = chosen
+            for path, value in chosen:
+                self._index.setdefault(path, {}).setdefault(value, set()).add(q)
 
     @_locked
     def remove(self, q):
-        self._queues.remove(q)
+        self._discard(q)
+
+    @_locked
+    def replace(self, old, new):
+        """ Deliver to ``new`` whatever would be delivered to ``old``. """
+        chosen = self._constraints.get(old)
+        self._discard(old)
+        self._insert(new, chosen)
+
+    def _targets(self, msg):
+        targets = set(self._queues)
+        for path, table in self._index.items():
+            for value in filtering.pluck(msg, path):
+                try:
+                    qs = table.get(value)
+                except TypeError:  # unhashable
+                    continue
+                if qs:
+                    targets.update(qs)
+        return targets
 
     @_locked
     def send(self, msg):
-        for q in self._queues:
+        for q in self._targets(msg):
             try:
                 q.put_nowait(msg)
             except queue.Full:
                 traceback.print_exc()
 
 
+_eviction_notice = object()  # put into a listener's queue to stop its delegate
+
 class Listener(object):
     def __init__(self, mic, q):
         self._mic = mic
         self._queue = q
         self._patterns = []
+        self._matchers = []
 
     def __del__(self):
         self._mic.remove(self._queue)
@@ -73,6 +152,34 @@ class Listener(object):
         All templates must produce a match for a message to be considered a match.
         """
         self._patterns.append(pattern)
+        self._matchers.append(filtering.compile_templates(pattern))
+
+        # Let microphone deliver only messages that can possibly match.
+        constraints = [filtering.find_constraints(p) for p in self._patterns]
+        self._mic.add(self._queue, constraints if all(constraints) else None)
+
+    def _move_to(self, q):
+        # Receive messages in another queue, bringing along those already received.
+        old, self._queue = self._queue, q
+        self._mic.replace(old, q)
+
+        while 1:
+            try:
+                q.put_nowait(old.get_nowait())
+            except queue.Empty:
+                break
+
+    def _match(self, msg):
+        if msg is _eviction_notice:
+            raise exception.StopListening('Evicted')
+
+        for m in self._matchers:
+            if m(msg):
+                return True
+        return False
+
+    def _evict(self):
+        self._queue.put_nowait(_eviction_notice)
 
     def wait(self):
         """
@@ -84,7 +191,7 @@ class Listener(object):
         while 1:
             msg = self._queue.get(block=True)
 
-            if any(map(lambda p: filtering.match_all(msg, p), self._patterns)):
+            if self._match(msg):
                 return msg
 
 
@@ -416,6 +523,8 @@ class CallbackQueryCoordinator(object):
 
         if contains(message_kw, 'reply_markup'):
             reply_markup = filtering.pick(message_kw, 'reply_markup')
+            if isinstance(reply_markup, Prepared):
+                reply_markup = reply_markup.value
             if contains(reply_markup, 'inline_keyboard'):
                 inline_keyboard = filtering.pick(reply_markup, 'inline_keyboard')
                 for array in inline_keyboard:
@@ -559,6 +668,7 @@ class CallbackQueryCoordinator(object):
         for name, value in filter(public_untouched, inspect.getmembers(bot)):
             setattr(proxy, name, value)
 
+        proxy._unaugmented = bot
         return proxy
 
 
@@ -655,22 +765,38 @@ class IdleEventCoordinator(object):
         self._scheduler = scheduler
         self._timeout_seconds = timeout
         self._timeout_event = None
+        self._last_active = None
 
     def refresh(self):
         """ Refresh timeout timer """
-        try:
-            if self._timeout_event:
-                self._scheduler.cancel(self._timeout_event)
+        # Only remember the time of activity. There is at most one timeout event
+        # outstanding. It is re-armed lazily, when it expires too early.
+        self._last_active = time.time()
 
-        # Timeout event has been popped from queue prematurely
-        except exception.EventNotFound:
-            pass
+        if self._timeout_event is None:
+            self._arm(self._timeout_seconds)
+
+    def _arm(self, delay):
+        self._timeout_event = self._scheduler.event_later(
+                                  delay,
+                                  ('_idle', {'seconds': self._timeout_seconds}))
 
-        # Ensure a new event is scheduled always
-        finally:
-            self._timeout_event = self._scheduler.event_later(
-                                      self._timeout_seconds,
-                                      ('_idle', {'seconds': self._timeout_seconds}))
+    def _accept_timeout(self, event):
+        # Decide whether a timeout event should reach the handler. If there has been
+        # activity since the timer was armed, re-arm it to expire `timeout` seconds
+        # after the latest activity.
+
+        # Ignore timeout event that is not the one outstanding
+        if self._timeout_event is None or getattr(self._timeout_event, 'data', event) is not event:
+            return False
+
+        remaining = self._last_active + self._timeout_seconds - time.time()
+        if remaining > 0:
+            self._arm(remaining)
+            return False
+
+        self._timeout_event = None
+        return True
 
     def augment_on_message(self, handler):
         """
@@ -682,8 +808,8 @@ class IdleEventCoordinator(object):
             # Reset timer if this is an external message
             is_event(msg) or self.refresh()
 
-            # Ignore timeout event that have been popped from queue prematurely
-            if flavor(msg) == '_idle' and msg is not self._timeout_event.data:
+            # Let timeout event through only if idle long enough
+            if flavor(msg) == '_idle' and not self._accept_timeout(msg):
                 return
 
             return handler(msg)
@@ -733,6 +859,136 @@ class IdleTerminateMixin(object):
         raise exception.IdleTerminate(event['_idle']['seconds'])
 
 
+class HibernationStore(object):
+    """
+    Keep delegates' hibernated state, pickled, in an SQLite database.
+    """
+    def __init__(self, path=''):
+        """
+        :param path:
+            database file. The default, an empty string, is a private temporary
+            file deleted when the store is garbage-collected. Give a real path to
+            keep state across restarts.
+        """
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS hibernation '
+                         '(kind TEXT, id TEXT, state BLOB, PRIMARY KEY (kind, id))')
+        self._db.commit()
+        self._lock = threading.Lock()
+
+    def save(self, kind, id, state):
+        data = pickle.dumps(state, pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO hibernation VALUES (?,?,?)',
+                             (kind, str(id), sqlite3.Binary(data)))
+            self._db.commit()
+
+    def load(self, kind, id):
+        """
+        :return: state saved, or ``None`` if nothing saved
+        """
+        with self._lock:
+            row = self._db.execute('SELECT state FROM hibernation WHERE kind=? AND id=?',
+                                   (kind, str(id))).fetchone()
+        return pickle.loads(bytes(row[0])) if row else None
+
+    def discard(self, kind, id):
+        with self._lock:
+            self._db.execute('DELETE FROM hibernation WHERE kind=? AND id=?', (kind, str(id)))
+            self._db.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM hibernation').fetchone()[0]
+
+
+_hibernation_stores = weakref.WeakKeyDictionary()  # bot -> its default store
+_hibernation_store_lock = threading.Lock()
+
+def _default_hibernation_store(bot):
+    # One per bot, so bots in the same process do not restore each other's state.
+    bot = getattr(bot, '_unaugmented', bot)  # the same for all of a bot's proxies
+    with _hibernation_store_lock:
+        store = _hibernation_stores.get(bot)
+        if store is None:
+            store = _hibernation_stores[bot] = HibernationStore()
+        return store
+
+
+class HibernateMixin(object):
+    """
+    Save the attributes named in ``hibernate`` when the delegate closes because it
+    has been idle (or evicted by :class:`.DelegatorBot`\'s ``maxlive``), and restore
+    them when a delegate of the same class is created for the same id again, just
+    before ``open()`` is called. A short idle timeout then costs no conversation state,
+    and memory is held only for active delegates.
+
+    If the delegate closes for any other reason, e.g. by calling ``close()``, the
+    saved state is discarded and the next delegate starts afresh.
+
+    Attributes must be picklable. They are kept in ``hibernation_store``, a
+    :class:`.HibernationStore`. By default, each bot has a temporary one shared
+    by all classes. A store set explicitly is shared by every bot using it, so
+    give each bot its own if they may have the same ids.
+    """
+    hibernate = []
+    hibernation_store = None
+
+    def __init__(self, *args, **kwargs):
+        super(HibernateMixin, self).__init__(*args, **kwargs)
+        self.open = self._augment_open(self.open)
+        self.on_close = self._augment_on_close(self.on_close)
+
+    def _hibernation(self):
+        # Qualify the class name, so same-named classes in other modules keep apart.
+        cls = type(self)
+        return (self.hibernation_store or _default_hibernation_store(self.bot),
+                '%s.%s' % (cls.__module__, getattr(cls, '__qualname__', cls.__name__)))
+
+    def _thaw(self, state):
+        if state:
+            for name, value in state.items():
+                setattr(self, name, value)
+
+    def _freeze(self, ex):
+        # Return the store method, and its arguments, to call on close
+        store, kind = self._hibernation()
+        if _is_dormant(ex):
+            return store.save, (kind, self.id,
+                    {name: getattr(self, name) for name in self.hibernate if hasattr(self, name)})
+        else:
+            return store.discard, (kind, self.id)
+
+    def _restore(self):
+        store, kind = self._hibernation()
+        self._thaw(store.load(kind, self.id))
+
+    def _hibernate(self, ex):
+        fn, args = self._freeze(ex)
+        fn(*args)
+
+    def _augment_open(self, handler):
+        def augmented(initial_msg, seed):
+            self._restore()
+            return handler(initial_msg, seed)
+        return augmented
+
+    def _augment_on_close(self, handler):
+        def augmented(ex):
+            try:
+                self._hibernate(ex)
+            except:
+                traceback.print_exc()
+            return handler(ex)
+        return augmented
+
+
+def _is_dormant(ex):
+    # Closed for lack of activity, not because the conversation is over
+    return (isinstance(ex, exception.IdleTerminate)
+                or isinstance(ex, exception.StopListening) and ex.args == ('Evicted',))
+
+
 class StandardEventScheduler(object):
     """
     A proxy to the underlying :class:`.Bot`\'s scheduler, this object implements
@@ -1023,9 +1279,15 @@ class Router(object):
         k = self.key_function(msg)
 
         if isinstance(k, (tuple, list)):
-            key, args, kwargs = {1: tuple(k) + ((),{}),
-                                 2: tuple(k) + ({},),
-                                 3: tuple(k),}[len(k)]
+            n = len(k)
+            if n == 2:
+                (key, args), kwargs = k, {}
+            elif n == 1:
+                key, args, kwargs = k[0], (), {}
+            elif n == 3:
+                key, args, kwargs = k
+            else:
+                raise KeyError(n)
         else:
             key, args, kwargs = k, (), {}
 
@@ -1,17 +1,17 @@
 import sys
 import time
-import json
 import threading
 import traceback
-import collections
+import bisect
 
 try:
     import Queue as queue
 except ImportError:
     import queue
 
-from . import exception
-from . import _find_first_key, flavor_router
+from . import codec
+from . import _find_first_key, flavor_router, is_event, peel, _ReorderBuffer
+from .retry import RetryPolicy
 
 
 class RunForeverAsThread(object):
@@ -22,29 +22,361 @@ class RunForeverAsThread(object):
 
 
 class CollectLoop(RunForeverAsThread):
-    def __init__(self, handle):
+    def __init__(self, handle, batch=1, handle_batch=None, maxsize=0):
+        """
+        :param handle: a function that takes one message
+        :param batch: maximum number of messages taken off the queue at a time
+        :param handle_batch:
+            a function that takes a list of messages. If given, it is called
+            instead of ``handle`` for each batch.
+        :param maxsize:
+            maximum number of messages queued. When full, putting in more blocks.
+            ``0`` means unbounded.
+        """
         self._handle = handle
-        self._inqueue = queue.Queue()
+        self._handle_batch = handle_batch
+        self._batch = batch
+        self._inqueue = queue.Queue(maxsize)
 
     @property
     def input_queue(self):
         return self._inqueue
 
+    def _get_batch(self):
+        # Take up to `batch` messages while holding the queue's lock only once,
+        # instead of once per message.
+        q = self._inqueue
+        with q.not_empty:
+            while not q._qsize():
+                q.not_empty.wait()
+            msgs = [q._get() for i in range(min(q._qsize(), self._batch))]
+            q.not_full.notify(len(msgs))
+        return msgs
+
     def run_forever(self):
+        if self._batch <= 1 and self._handle_batch is None:
+            while 1:
+                try:
+                    msg = self._inqueue.get(block=True)
+                    self._handle(msg)
+                except:
+                    traceback.print_exc()
+
         while 1:
             try:
-                msg = self._inqueue.get(block=True)
-                self._handle(msg)
+                msgs = self._get_batch()
             except:
                 traceback.print_exc()
+                continue
+
+            if self._handle_batch:
+                try:
+                    self._handle_batch(msgs)
+                except:
+                    traceback.print_exc()
+            else:
+                for msg in msgs:
+                    try:
+                        self._handle(msg)
+                    except:
+                        traceback.print_exc()
+
+
+def _shard_key(msg):
+    # Chat id for chat messages and callback queries from chats, from id for
+    # other messages, source id for events. Events follow messages to the same
+    # shard only for delegates seeded by chat id, e.g. `per_chat_id()`.
+    try:
+        if 'chat' in msg:
+            return msg['chat']['id']
+        elif 'message' in msg:
+            return msg['message']['chat']['id']
+        elif 'from' in msg:
+            return msg['from']['id']
+        elif is_event(msg):
+            return peel(msg)['source']['id']
+    except (KeyError, TypeError):
+        pass
+    return None
+
+
+class _ShardedQueue(object):
+    def __init__(self, queues, key):
+        self._queues = queues
+        self._key = key
+
+    def _which(self, msg):
+        try:
+            return self._queues[hash(self._key(msg)) % len(self._queues)]
+        except TypeError:  # unhashable key
+            return self._queues[0]
+
+    def put(self, msg, block=True, timeout=None):
+        self._which(msg).put(msg, block, timeout)
+
+    def put_nowait(self, msg):
+        self._which(msg).put_nowait(msg)
+
+
+class ShardedCollectLoop(RunForeverAsThread):
+    def __init__(self, handle, workers, key=None, maxsize=0, **kwargs):
+        """
+        Handle messages on multiple threads. Messages with the same key always go
+        to the same thread, so they are handled in the order they are put.
+
+        :param workers: number of threads
+
+        :param key:
+            a function that takes a message and returns a key, like seeders in
+            :mod:`telepot.delegate`. If ``None``, messages are keyed by chat id,
+            or from id if there is no chat. Events, e.g. timeouts, are keyed by the
+            id of the delegate they are for, so they keep their order relative to
+            its messages only if that id is the chat id. For delegates seeded
+            otherwise, e.g. by ``per_from_id()``, pass a key giving the same id to
+            both, e.g. ``lambda msg: telepot.peel(msg)['source']['id']
+            if telepot.is_event(msg) else msg['from']['id']``.
+
+        :param maxsize:
+            maximum number of messages queued per thread. When full, putting in
+            more blocks. ``0`` means unbounded.
+
+        Other keyword arguments are passed to each thread's :class:`.CollectLoop`.
+        """
+        self._loops = [CollectLoop(handle, maxsize=maxsize, **kwargs) for i in range(workers)]
+        self._inqueue = _ShardedQueue([c.input_queue for c in self._loops],
+                                      key or _shard_key)
+
+    @property
+    def input_queue(self):
+        return self._inqueue
+
+    def run_forever(self):
+        for c in self._loops[1:]:
+            c.run_as_thread()
+        self._loops[0].run_forever()
+
+
+def _create_collectloop(handle, workers=1, key=None, maxsize=0, batch=1, handle_batch=None):
+    if workers > 1:
+        return ShardedCollectLoop(handle, workers, key=key, maxsize=maxsize,
+                                  batch=batch, handle_batch=handle_batch)
+    else:
+        return CollectLoop(handle, batch=batch, handle_batch=handle_batch, maxsize=maxsize)
+
+
+def _process_worker(handle_factory, inqueue, limiter):
+    if limiter:
+        from . import api
+        api.set_rate_limiter(limiter)
+
+    h = handle_factory()
+
+    # A bot is given. Use its handle method, and deliver its scheduler's events.
+    if hasattr(h, 'scheduler'):
+        collectloop = CollectLoop(h.handle)
+        h.scheduler.on_event(collectloop.input_queue.put)
+        h.scheduler.run_as_thread()
+    else:
+        collectloop = CollectLoop(h)
+
+    def feed():
+        while 1:
+            collectloop.input_queue.put(inqueue.get())
+
+    t = threading.Thread(target=feed)
+    t.daemon = True
+    t.start()
+
+    collectloop.run_forever()
+
+
+class ProcessDispatcher(object):
+    def __init__(self, handle_factory, processes=None, key=None, maxsize=0, limiter=None):
+        """
+        A message-handling function that ships messages to worker processes,
+        to be handled there. Useful when handlers are CPU-heavy, so they do not
+        starve threads receiving updates in the main process.
+
+        Pass it to :class:`.MessageLoop`, :class:`.Webhook`, or :class:`.OrderedWebhook`
+        as ``handle``. Create it before starting any threads, as worker processes
+        are started right away.
+
+        :param handle_factory:
+            a function that is called once in each worker process, and returns
+            either a message-handling function or a bot. If a bot is returned,
+            its ``handle`` method is used and its scheduler is run. Replies should
+            be sent through bots created in worker processes. Under the ``spawn``
+            start method, it has to be picklable (e.g. a module-level function).
+
+        :param processes: number of worker processes. If ``None``, number of CPUs.
+
+        :param key:
+            a function that takes a message and returns a key, like seeders in
+            :mod:`telepot.delegate`. Messages with the same key go to the same worker
+            process, in order. If ``None``, messages are keyed by chat id, or
+            from id if there is no chat.
+
+        :param maxsize:
+            maximum number of messages queued per worker process. When full, calls
+            block. ``0`` means unbounded.
+
+        :param limiter:
+            a :class:`telepot.ratelimit.RateLimiter` created with ``shared=True``,
+            installed in every worker process. The global limit is shared by all
+            workers. Per-chat limits are kept by the worker handling that chat.
+            If ``None``, a default one is created. If ``False``, no limit.
+        """
+        import multiprocessing
+
+        processes = processes or multiprocessing.cpu_count()
+
+        if limiter is None:
+            from .ratelimit import RateLimiter
+            limiter = RateLimiter(shared=True)
+
+        self._key = key or _shard_key
+        self._queues = [multiprocessing.Queue(maxsize) for i in range(processes)]
+        self._processes = [multiprocessing.Process(target=_process_worker,
+                                                   args=(handle_factory, q, limiter))
+                               for q in self._queues]
+
+        for p in self._processes:
+            p.daemon = True
+            p.start()
+
+    def __call__(self, msg):
+        try:
+            q = self._queues[hash(self._key(msg)) % len(self._queues)]
+        except TypeError:  # unhashable key
+            q = self._queues[0]
+        q.put(msg)
+
+    def close(self):
+        """
+        Terminate worker processes. Messages not yet handled are lost.
+        """
+        for p in self._processes:
+            p.terminate()
+        for p in self._processes:
+            p.join()
+
+
+class LatencyHistogram(object):
+    """
+    Counts end-to-end latencies of updates, from the time Telegram dates a message
+    to the time it is dispatched. Message dates are in whole seconds, so latencies
+    are accurate to about one second. Updates without a date (e.g. callback
+    queries) are not counted.
+    """
+    BOUNDS = (0.5, 1, 2, 3, 5, 10, 30, 60)
+
+    def __init__(self, bounds=BOUNDS):
+        """
+        :param bounds: upper bounds of buckets in seconds, in increasing order
+        """
+        self._bounds = list(bounds)
+        self._counts = [0] * (len(self._bounds) + 1)
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        i = bisect.bisect_left(self._bounds, seconds)
+        with self._lock:
+            self._counts[i] += 1
+            self._sum += seconds
+
+    def add_update(self, update, now=None):
+        try:
+            msg = _extract_message(update)[1]
+        except KeyError:  # unknown update type
+            return
+
+        date = msg.get('edit_date') or msg.get('date')
+        if date:
+            self.add((now or time.time()) - date)
+
+    def snapshot(self):
+        """
+        :return:
+            a dictionary of ``count``, ``mean`` (seconds), and ``buckets``, a list of
+            ``(upper bound, count)`` ending with an unbounded ``(inf, count)``
+        """
+        with self._lock:
+            counts, total = list(self._counts), self._sum
+
+        n = sum(counts)
+        return {'count': n,
+                'mean': total / n if n else None,
+                'buckets': list(zip(self._bounds + [float('inf')], counts))}
+
+    def percentile(self, p):
+        """
+        :param p: percentage, e.g. ``99``
+        :return: upper bound of the bucket within which ``p`` percent of latencies fall
+        """
+        with self._lock:
+            counts = list(self._counts)
+
+        target = sum(counts) * p / 100.0
+        seen = 0
+        for bound, c in zip(self._bounds + [float('inf')], counts):
+            seen += c
+            if seen >= target and seen > 0:
+                return bound
+        return None
 
 
 class GetUpdatesLoop(RunForeverAsThread):
-    def __init__(self, bot, on_update):
+    def __init__(self, bot, on_update, latency=None):
+        """
+        :param latency: a :class:`.LatencyHistogram` to record into. If ``None``, a new one.
+        """
         self._bot = bot
         self._update_handler = on_update
+        self.latency = latency or LatencyHistogram()
+
+    def _dispatch(self, update):
+        self.latency.add_update(update)
+        self._update_handler(update)
+
+    def _run_pipelined(self, offset, timeout, allowed_updates, retry):
+        batches = queue.Queue(4)  # stop polling if handling falls too far behind
+
+        def dispatch_forever():
+            while 1:
+                for update in batches.get():
+                    try:
+                        self._dispatch(update)
+                    except:
+                        traceback.print_exc()
+
+        t = threading.Thread(target=dispatch_forever)
+        t.daemon = True
+        t.start()
 
-    def run_forever(self, relax=0.1, offset=None, timeout=20, allowed_updates=None):
+        while 1:
+            time.sleep(retry.attempt())
+            try:
+                result = self._bot.getUpdates(offset=offset,
+                                              timeout=timeout,
+                                              allowed_updates=allowed_updates)
+            except Exception as e:
+                traceback.print_exc()
+                time.sleep(retry.failure(e))
+                continue
+
+            retry.success()
+
+            # Once passed, this parameter is no longer needed.
+            allowed_updates = None
+
+            # Advance offset before handling, so next poll goes out right away.
+            if result:
+                offset = result[-1]['update_id'] + 1
+                batches.put(result)
+
+    def run_forever(self, relax=0.1, offset=None, timeout=20, allowed_updates=None,
+                    pipeline=False, retry=None):
         """
         Process new updates in infinity loop
 
@@ -52,27 +384,41 @@ class GetUpdatesLoop(RunForeverAsThread):
         :param offset: int
         :param timeout: int
         :param allowed_updates: bool
+        :param pipeline:
+            If ``True``, updates are handled on another thread, while the next
+            poll goes out immediately. ``relax`` has no effect then.
+
+        :param retry:
+            a :class:`telepot.retry.RetryPolicy` deciding how long to wait after
+            ``getUpdates`` fails. If ``None``, a default one is used.
         """
+        if retry is None:
+            retry = RetryPolicy()
+
+        if pipeline:
+            return self._run_pipelined(offset, timeout, allowed_updates, retry)
+
         while 1:
+            time.sleep(retry.attempt())
             try:
                 result = self._bot.getUpdates(offset=offset,
                                               timeout=timeout,
                                               allowed_updates=allowed_updates)
+            except Exception as e:
+                traceback.print_exc()
+                time.sleep(retry.failure(e))
+                continue
+
+            retry.success()
 
-                # Once passed, this parameter is no longer needed.
-                allowed_updates = None
+            # Once passed, this parameter is no longer needed.
+            allowed_updates = None
 
+            try:
                 # No sort. Trust server to give messages in correct order.
                 for update in result:
-                    self._update_handler(update)
+                    self._dispatch(update)
                     offset = update['update_id'] + 1
-
-            except exception.BadHTTPResponse as e:
-                traceback.print_exc()
-
-                # Servers probably down. Wait longer.
-                if e.status == 502:
-                    time.sleep(30)
             except:
                 traceback.print_exc()
             finally:
@@ -80,10 +426,8 @@ class GetUpdatesLoop(RunForeverAsThread):
 
 
 def _dictify3(data):
-    if type(data) is bytes:
-        return json.loads(data.decode('utf-8'))
-    elif type(data) is str:
-        return json.loads(data)
+    if type(data) in [bytes, str]:
+        return codec.loads(data)
     elif type(data) is dict:
         return data
     else:
@@ -91,7 +435,7 @@ def _dictify3(data):
 
 def _dictify27(data):
     if type(data) in [str, unicode]:
-        return json.loads(data)
+        return codec.loads(data)
     elif type(data) is dict:
         return data
     else:
@@ -121,9 +465,45 @@ def _infer_handler_function(bot, h):
 
 
 class MessageLoop(RunForeverAsThread):
-    def __init__(self, bot, handle=None):
+    def __init__(self, bot, handle=None, workers=1, key=None, maxsize=0,
+                 batch=1, handle_batch=None):
+        """
+        :param workers:
+            number of threads handling messages. If more than one, messages are
+            distributed by ``key``. Messages with the same key are handled in order
+            on the same thread, messages with different keys in parallel.
+
+        :param key:
+            a function that takes a message and returns a key, like seeders in
+            :mod:`telepot.delegate`. If ``None``, messages are keyed by chat id,
+            or from id if there is no chat. Events, e.g. timeouts, are keyed by the
+            id of the delegate they are for, so they keep their order relative to
+            its messages only if that id is the chat id. For delegates seeded
+            otherwise, e.g. by ``per_from_id()``, pass a key giving the same id to
+            both, e.g. ``lambda msg: telepot.peel(msg)['source']['id']
+            if telepot.is_event(msg) else msg['from']['id']``.
+
+        :param maxsize:
+            maximum number of messages queued per thread. When full, receiving
+            updates pauses. ``0`` means unbounded.
+
+        :param batch:
+            maximum number of messages each thread takes off its queue at a time
+
+        :param handle_batch:
+            a function that takes a list of messages (and scheduled events).
+            If given, it is called instead of ``handle`` for each batch.
+        """
         self._bot = bot
         self._handle = _infer_handler_function(bot, handle)
+        self._collect_options = dict(workers=workers, key=key, maxsize=maxsize,
+                                     batch=batch, handle_batch=handle_batch)
+        self._latency = LatencyHistogram()
+
+    @property
+    def latency(self):
+        """ A :class:`.LatencyHistogram` of updates received """
+        return self._latency
 
     def run_forever(self, *args, **kwargs):
         """
@@ -144,14 +524,25 @@ class MessageLoop(RunForeverAsThread):
             ``allowed_updates`` parameter supplied to :meth:`.getUpdates`,
             controlling which types of updates to receive.
 
+        :type pipeline: bool
+        :param pipeline:
+            If ``True``, the next :meth:`.getUpdates` goes out as soon as updates
+            are received, while they are being handled. ``relax`` does not apply.
+
+        :type retry: :class:`telepot.retry.RetryPolicy`
+        :param retry:
+            deciding how long to wait after :meth:`.getUpdates` fails, with
+            exponential backoff and a circuit breaker. If ``None``, a default one is used.
+
         Calling this method will block forever. Use :meth:`.run_as_thread` to
         run it non-blockingly.
         """
-        collectloop = CollectLoop(self._handle)
+        collectloop = _create_collectloop(self._handle, **self._collect_options)
         updatesloop = GetUpdatesLoop(self._bot,
                                      lambda update:
-                                         collectloop.input_queue.put(_extract_message(update)[1]))
+                                         collectloop.input_queue.put(_extract_message(update)[1]),
                                          # feed messages to collect loop
+                                     latency=self._latency)
         # feed events to collect loop
         self._bot.scheduler.on_event(collectloop.input_queue.put)
         self._bot.scheduler.run_as_thread()
@@ -161,9 +552,15 @@ class MessageLoop(RunForeverAsThread):
 
 
 class Webhook(RunForeverAsThread):
-    def __init__(self, bot, handle=None):
+    def __init__(self, bot, handle=None, workers=1, key=None, maxsize=0,
+                 batch=1, handle_batch=None):
+        """
+        See :class:`.MessageLoop` for ``workers``, ``key``, ``maxsize``,
+        ``batch`` and ``handle_batch``.
+        """
         self._bot = bot
-        self._collectloop = CollectLoop(_infer_handler_function(bot, handle))
+        self._collectloop = _create_collectloop(_infer_handler_function(bot, handle),
+                                                workers, key, maxsize, batch, handle_batch)
 
     def run_forever(self):
         # feed events to collect loop
@@ -192,90 +589,29 @@ class Orderer(RunForeverAsThread):
             return update['update_id']
 
         # Here is the re-ordering mechanism, ensuring in-order delivery of updates.
-        max_id = None                 # max update_id passed to callback
-        buffer = collections.deque()  # keep those updates which skip some update_id
-        qwait = None                  # how long to wait for updates,
-                                      # because buffer's content has to be returned in time.
+        buffer = _ReorderBuffer(handle, maxhold)
 
         while 1:
             try:
-                update = self._inqueue.get(block=True, timeout=qwait)
-
-                if max_id is None:
-                    # First message received, handle regardless.
-                    max_id = handle(update)
-
-                elif update['update_id'] == max_id + 1:
-                    # No update_id skipped, handle naturally.
-                    max_id = handle(update)
-
-                    # clear contagious updates in buffer
-                    if len(buffer) > 0:
-                        buffer.popleft()  # first element belongs to update just received, useless now.
-                        while 1:
-                            try:
-                                if type(buffer[0]) is dict:
-                                    max_id = handle(buffer.popleft())  # updates that arrived earlier, handle them.
-                                else:
-                                    break  # gap, no more contagious updates
-                            except IndexError:
-                                break  # buffer empty
-
-                elif update['update_id'] > max_id + 1:
-                    # Update arrives pre-maturely, insert to buffer.
-                    nbuf = len(buffer)
-                    if update['update_id'] <= max_id + nbuf:
-                        # buffer long enough, put update at position
-                        buffer[update['update_id'] - max_id - 1] = update
-                    else:
-                        # buffer too short, lengthen it
-                        expire = time.time() + maxhold
-                        for a in range(nbuf, update['update_id']-max_id-1):
-                            buffer.append(expire)  # put expiry time in gaps
-                        buffer.append(update)
-
-                else:
-                    pass  # discard
-
+                update = self._inqueue.get(block=True, timeout=buffer.wait_time())
+                buffer.put(update)
             except queue.Empty:
-                # debug message
-                # print('Timeout')
-
-                # some buffer contents have to be handled
-                # flush buffer until a non-expired time is encountered
-                while 1:
-                    try:
-                        if type(buffer[0]) is dict:
-                            max_id = handle(buffer.popleft())
-                        else:
-                            expire = buffer[0]
-                            if expire <= time.time():
-                                max_id += 1
-                                buffer.popleft()
-                            else:
-                                break  # non-expired
-                    except IndexError:
-                        break  # buffer empty
+                # some held updates have to be handled
+                buffer.flush()
             except:
                 traceback.print_exc()
-            finally:
-                try:
-                    # don't wait longer than next expiry time
-                    qwait = buffer[0] - time.time()
-                    if qwait < 0:
-                        qwait = 0
-                except IndexError:
-                    # buffer empty, can wait forever
-                    qwait = None
-
-                # debug message
-                # print ('Buffer:', str(buffer), ', To Wait:', qwait, ', Max ID:', max_id)
 
 
 class OrderedWebhook(RunForeverAsThread):
-    def __init__(self, bot, handle=None):
+    def __init__(self, bot, handle=None, workers=1, key=None, maxsize=0,
+                 batch=1, handle_batch=None):
+        """
+        See :class:`.MessageLoop` for ``workers``, ``key``, ``maxsize``,
+        ``batch`` and ``handle_batch``.
+        """
         self._bot = bot
-        self._collectloop = CollectLoop(_infer_handler_function(bot, handle))
+        self._collectloop = _create_collectloop(_infer_handler_function(bot, handle),
+                                                workers, key, maxsize, batch, handle_batch)
         self._orderer = Orderer(lambda update:
                                     self._collectloop.input_queue.put(_extract_message(update)[1]))
                                     # feed messages to collect loop
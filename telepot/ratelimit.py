@@ -0,0 +1,206 @@
+"""
+Outbound rate limiting, to stay within Telegram's
+`flood limits <https://core.telegram.org/bots/faq#my-bot-is-hitting-limits-how-do-i-avoid-this>`_.
+
+Install a :class:`RateLimiter` with :func:`telepot.api.set_rate_limiter`
+(or :func:`telepot.aio.api.set_rate_limiter`), and every request waits its turn.
+"""
+
+import time
+import threading
+
+
+class Bucket(object):
+    """
+    Allow ``rate`` requests per second on average, up to ``burst`` at once.
+    Implemented as a generic cell rate algorithm (GCRA), which only keeps a
+    *theoretical arrival time* (``tat``).
+    """
+    def __init__(self, rate, burst=1):
+        self.interval = 1.0 / rate
+        self.tolerance = (burst - 1) * self.interval
+        self.tat = 0.0
+
+    def earliest(self):
+        """ Earliest time at which the next request is allowed """
+        return self.tat - self.tolerance
+
+    def take(self, t):
+        """ Record a request made at time ``t`` """
+        self.tat = max(self.tat, t) + self.interval
+
+    def block_until(self, t):
+        """ Allow no requests before time ``t`` """
+        self.tat = max(self.tat, t + self.tolerance)
+
+
+class _SharedBucket(Bucket):
+    # Theoretical arrival time kept in shared memory, visible to child processes.
+    def __init__(self, rate, burst=1):
+        import multiprocessing
+        self._tat = multiprocessing.Value('d', 0.0, lock=False)
+        super(_SharedBucket, self).__init__(rate, burst)
+
+    @property
+    def tat(self):
+        return self._tat.value
+
+    @tat.setter
+    def tat(self, value):
+        self._tat.value = value
+
+
+class RateLimiter(object):
+    def __init__(self, global_rate=30, chat_rate=1, group_rate=20/60.0,
+                 global_burst=1, chat_burst=1, group_burst=1,
+                 retries=3, shared=False):
+        """
+        Limit requests to all chats combined, to each chat, and additionally
+        to each group or channel (chat id negative or ``@channelusername``).
+        Requests without ``chat_id`` count towards the global limit only.
+        ``getUpdates`` is never limited.
+
+        On *429 Too Many Requests*, the affected chat (or everything, if no chat
+        is involved) is blocked for ``retry_after`` seconds as told by Telegram,
+        and the request retried up to ``retries`` times. Requests uploading files
+        are not retried, because files cannot be re-read reliably.
+
+        :param global_rate: requests per second to all chats combined
+        :param chat_rate: requests per second to one chat
+        :param group_rate: requests per second to one group or channel
+        :param global_burst, chat_burst, group_burst: requests allowed at once
+
+        :param shared:
+            If ``True``, the global limit is shared with child processes created
+            afterwards (e.g. by :class:`telepot.loop.ProcessDispatcher`), which
+            should install this object in their own process.
+        """
+        if shared:
+            import multiprocessing
+            self._lock = multiprocessing.Lock()
+            self._global = _SharedBucket(global_rate, global_burst)
+        else:
+            self._lock = threading.Lock()
+            self._global = Bucket(global_rate, global_burst)
+
+        self._chat_spec = (chat_rate, chat_burst)
+        self._group_spec = (group_rate, group_burst)
+        self._chats = {}
+        self._groups = {}
+        self._reservations = 0
+
+        self.retries = retries
+        self._stats = {k: {'requests': 0, 'delayed': 0, 'delay': 0.0, 'throttled': 0}
+                           for k in ['global', 'chat', 'group']}
+
+    def _buckets(self, req):
+        token, method, params, files = req
+
+        buckets = [('global', self._global)]
+
+        chat_id = params.get('chat_id') if params else None
+        if chat_id is None:
+            return buckets
+
+        for kind, table, spec, applies in [
+                ('chat', self._chats, self._chat_spec, True),
+                ('group', self._groups, self._group_spec, _is_group(chat_id))]:
+            if not applies:
+                continue
+            b = table.get(chat_id)
+            if b is None:
+                b = table[chat_id] = Bucket(*spec)
+            buckets.append((kind, b))
+
+        return buckets
+
+    def _prune(self, now):
+        # A bucket whose theoretical arrival time has passed is no different
+        # from a fresh one. Drop it.
+        for table in [self._chats, self._groups]:
+            for k in [k for k,b in table.items() if b.tat <= now]:
+                del table[k]
+
+    def reserve(self, req):
+        """
+        Reserve a slot for a request.
+
+        :param req: a ``(token, method, params, files)`` tuple, as given to :func:`telepot.api.request`
+        :return: seconds to wait before making the request
+        """
+        token, method, params, files = req
+        if method == 'getUpdates':
+            return 0
+
+        with self._lock:
+            now = time.time()
+            buckets = self._buckets(req)
+
+            # Wait for the most restrictive bucket, which takes the blame in stats.
+            t, kind = max([(now, None)] + [(b.earliest(), kind) for kind, b in buckets],
+                          key=lambda x: x[0])
+            delay = t - now
+
+            if kind:
+                self._stats[kind]['delayed'] += 1
+                self._stats[kind]['delay'] += delay
+
+            for k, b in buckets:
+                b.take(t)
+                self._stats[k]['requests'] += 1
+
+            self._reservations += 1
+            if self._reservations % 1000 == 0:
+                self._prune(now)
+
+        return delay
+
+    def backoff(self, req, e):
+        """
+        Block further requests as told by a *429 Too Many Requests* error.
+
+        :param req: a ``(token, method, params, files)`` tuple, as given to :func:`telepot.api.request`
+        :param e: a :class:`telepot.exception.TelegramError`
+
+        :return:
+            ``True`` if ``e`` is a *429* error and the request may be retried,
+            ``False`` otherwise. ``getUpdates`` is never retried here, nor does it
+            block other requests; the polling loop waits out ``retry_after`` itself.
+        """
+        token, method, params, files = req
+        if method == 'getUpdates':
+            return False
+
+        try:
+            if e.error_code != 429:
+                return False
+            retry_after = e.json['parameters']['retry_after']
+        except (KeyError, TypeError):
+            return False
+
+        with self._lock:
+            # Block the chat involved, or everything if no chat is involved.
+            buckets = self._buckets(req)
+            for kind, b in buckets[1:] or buckets:
+                b.block_until(time.time() + retry_after)
+                self._stats[kind]['throttled'] += 1
+
+        return not files
+
+    def stats(self):
+        """
+        :return:
+            a dictionary of ``global``, ``chat``, and ``group`` statistics.
+            Each gives the number of ``requests`` counted, how many were ``delayed``
+            by that limit and by how many seconds (``delay``) in total, and how many times
+            Telegram said *Too Many Requests* (``throttled``).
+        """
+        with self._lock:
+            return {k: dict(v) for k,v in self._stats.items()}
+
+
+def _is_group(chat_id):
+    try:
+        return int(chat_id) < 0
+    except (TypeError, ValueError):
+        return True  # @channelusername
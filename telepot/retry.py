@@ -0,0 +1,127 @@
+"""
+Deciding how long to wait after a failed request, used by loops that poll
+``getUpdates``.
+"""
+
+import time
+import random
+import threading
+import traceback
+
+
+class RetryPolicy(object):
+    """
+    Exponential backoff with full jitter, and a circuit breaker.
+
+    After each consecutive failure, the delay is chosen uniformly between zero and
+    ``base * factor ** (failures - 1)``, capped at ``max_delay``.
+
+    After ``threshold`` consecutive failures, the circuit *opens*: the next attempt
+    is delayed by ``open_timeout`` seconds. That attempt is a trial
+    (*half-open*). If it succeeds, the circuit *closes* and everything is back
+    to normal. If it fails, the circuit opens again.
+
+    A *Too Many Requests* error's ``retry_after`` is always respected.
+
+    Typical usage::
+
+        try:
+            time.sleep(policy.attempt())
+            do_something()
+        except Exception as e:
+            time.sleep(policy.failure(e))
+        else:
+            policy.success()
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, base=0.1, factor=2, max_delay=30,
+                 threshold=10, open_timeout=60, on_transition=None):
+        """
+        :param on_transition:
+            a function taking two arguments, the old state and the new state,
+            called whenever the circuit changes state. Useful for alerting.
+        """
+        self.base = base
+        self.factor = factor
+        self.max_delay = max_delay
+        self.threshold = threshold
+        self.open_timeout = open_timeout
+        self.on_transition = on_transition
+
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = None
+
+    @property
+    def state(self):
+        return self._state
+
+    @property
+    def failures(self):
+        """ Number of consecutive failures """
+        return self._failures
+
+    def _transit(self, state):
+        old, self._state = self._state, state
+        if old != state and self.on_transition:
+            try:
+                self.on_transition(old, state)
+            except:
+                traceback.print_exc()
+
+    def attempt(self):
+        """
+        Call before each attempt.
+
+        :return: seconds left before the circuit allows an attempt; ``0`` if allowed now
+        """
+        with self._lock:
+            if self._state == self.OPEN:
+                remaining = self._opened_at + self.open_timeout - time.time()
+                if remaining > 0:
+                    return remaining
+                self._transit(self.HALF_OPEN)
+            return 0
+
+    def success(self):
+        """ Call after a successful attempt. """
+        with self._lock:
+            self._failures = 0
+            if self._state != self.CLOSED:
+                self._transit(self.CLOSED)
+
+    def failure(self, e=None):
+        """
+        Call after a failed attempt.
+
+        :param e: the exception raised, if any
+        :return: seconds to wait before next attempt
+        """
+        with self._lock:
+            self._failures += 1
+
+            if self._state == self.HALF_OPEN or (self._state == self.CLOSED
+                                                  and self._failures >= self.threshold):
+                self._opened_at = time.time()
+                self._transit(self.OPEN)
+
+            if self._state == self.OPEN:
+                delay = self._opened_at + self.open_timeout - time.time()
+            else:
+                ceiling = min(self.max_delay, self.base * self.factor ** min(self._failures - 1, 64))
+                delay = random.uniform(0, ceiling)
+
+        return max(delay, _retry_after(e))
+
+
+def _retry_after(e):
+    try:
+        if e.error_code == 429:
+            return e.json['parameters']['retry_after']
+    except (AttributeError, KeyError, TypeError):
+        pass
+    return 0
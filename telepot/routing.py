@@ -27,7 +27,14 @@ def by_content_type():
         return content_type, (msg[content_type],)
     return f
 
-def by_command(extractor, prefix=('/',), separator=' ', pass_args=False):
+def _compile_prefixes(prefix):
+    # {first character: [prefixes starting with it, in original order]}
+    table = {}
+    for px in prefix:
+        table.setdefault(px[:1], []).append(px)
+    return table
+
+def by_command(extractor, prefix=('/',), separator=' ', pass_args=False, username=None):
     """
     :param extractor:
         a function that takes one argument (the message) and returns a portion
@@ -45,6 +52,11 @@ def by_command(extractor, prefix=('/',), separator=' ', pass_args=False):
         If ``True``, arguments following a command will be passed to the handler
         function.
 
+    :param username:
+        the bot's username. If given, a command in the form ``/command@username``
+        is reduced to ``command``. A command addressed to another bot is treated
+        as no command at all.
+
     :return:
         a key function that interprets a specific part of a message and returns
         the embedded command, optionally followed by arguments. If the text is
@@ -55,16 +67,58 @@ def by_command(extractor, prefix=('/',), separator=' ', pass_args=False):
     if not isinstance(prefix, (tuple, list)):
         prefix = (prefix,)
 
+    prefixes = _compile_prefixes(prefix)
+
+    if '' in prefixes:
+        # An empty prefix matches anything. Fall back to checking in order.
+        def find_prefix(text):
+            for px in prefix:
+                if text.startswith(px):
+                    return px
+            return None
+    else:
+        def find_prefix(text):
+            for px in prefixes.get(text[:1], ()):
+                if text.startswith(px):
+                    return px
+            return None
+
+    at_username = '@' + username.lower() if username else None
+
+    def strip_username(command):
+        head, at, tail = command.partition('@')
+        if not at:
+            return command
+        elif at + tail.lower() == at_username:
+            return head
+        else:
+            return None
+
     def f(msg):
         text = extractor(msg)
-        for px in prefix:
-            if text.startswith(px):
-                chunks = text[len(px):].split(separator)
-                return chunks[0], (chunks[1:],) if pass_args else ()
-        return (None,),  # to distinguish with `None`
+        px = find_prefix(text)
+        if px is None:
+            return (None,),  # to distinguish with `None`
+
+        if pass_args:
+            chunks = text[len(px):].split(separator)
+            command, args = chunks[0], (chunks[1:],)
+        else:
+            if separator is None:
+                command = (text[len(px):].split(None, 1) or [''])[0]
+            else:
+                command = text[len(px):].partition(separator)[0]
+            args = ()
+
+        if at_username:
+            command = strip_username(command)
+            if command is None:
+                return (None,),  # for another bot
+
+        return command, args
     return f
 
-def by_chat_command(prefix=('/',), separator=' ', pass_args=False):
+def by_chat_command(prefix=('/',), separator=' ', pass_args=False, username=None):
     """
     :param prefix:
         a list of special characters expected to indicate the head of a command.
@@ -77,6 +131,10 @@ def by_chat_command(prefix=('/',), separator=' ', pass_args=False):
         If ``True``, arguments following a command will be passed to the handler
         function.
 
+    :param username:
+        the bot's username, to recognize commands in the form ``/command@username``.
+        See :func:`by_command`.
+
     :return:
         a key function that interprets a chat message's text and returns
         the embedded command, optionally followed by arguments. If the text is
@@ -84,7 +142,7 @@ def by_chat_command(prefix=('/',), separator=' ', pass_args=False):
         ``(None,)`` as the key. This is to distinguish with the special
         ``None`` key in routing table.
     """
-    return by_command(lambda msg: msg['text'], prefix, separator, pass_args)
+    return by_command(lambda msg: msg['text'], prefix, separator, pass_args, username)
 
 def by_text():
     """
@@ -131,6 +189,37 @@ def by_regex(extractor, regex, key=1):
             return (None,),  # to distinguish with `None`
     return f
 
+def by_regexes(extractor, patterns):
+    """
+    :param extractor:
+        a function that takes one argument (the message) and returns a portion
+        of message to be interpreted. To extract the text of a chat message,
+        use ``lambda msg: msg['text']``.
+
+    :param patterns:
+        a list of ``(regex, key)`` tuples. ``regex`` may be a string or a regex object.
+
+    :return:
+        a key function that returns the ``key`` of the first ``regex`` found in the
+        text, and the match object as a positional argument.
+        If no match is found, it returns a 1-tuple ``(None,)`` as the key.
+        This is to distinguish with the special ``None`` key in routing table.
+
+    It is equivalent to a chain of routers each using :func:`by_regex`, with
+    one's default handler leading to the next, but without the overhead of
+    going through one router per regex.
+    """
+    patterns = [(re.compile(r) if _isstring(r) else r, k) for r,k in patterns]
+
+    def f(msg):
+        text = extractor(msg)
+        for regex, k in patterns:
+            match = regex.search(text)
+            if match:
+                return k, (match,)
+        return (None,),  # to distinguish with `None`
+    return f
+
 def process_key(processor, fn):
     """
     :param processor:
@@ -4,7 +4,7 @@ import random
 import telepot.aio
 from telepot.aio.routing import (by_content_type, make_content_type_routing_table,
                                    lower_key, by_chat_command, make_routing_table,
-                                   by_regex)
+                                   by_regex, by_regexes)
 
 def random_key(msg):
     return random.choice([
@@ -112,6 +112,27 @@ async def fake2():
     print()
 
 
+username_router = telepot.aio.helper.Router(lower_key(by_chat_command(username='MyBot')),
+                                              make_routing_table(command_handler, [
+                                                  'start',
+                                                  'settings',
+                                                  ((None,), command_handler.on_invalid_text),
+                                                  (None, command_handler.on_invalid_command),
+                                              ]))
+
+async def fake2a():
+    messages = [{'text': '/start'},
+                {'text': '/start@MyBot'},
+                {'text': '/SETTINGS@mybot now'},
+                {'text': '/start@OtherBot'},  # for another bot, taken as plain text
+                {'text': '/bad@MyBot'},]
+    make_message_like(messages)
+
+    for msg in messages:
+        await username_router.route(msg)
+    print()
+
+
 class RegexHandler(object):
     def on_CS101(self, msg, match):
         print('Someone mentioned CS101 !!!', msg, match.groups())
@@ -154,6 +175,38 @@ async def fake3():
     print()
 
 
+class CourseHandler(object):
+    def on_cs(self, msg, match):
+        print('CS course', match.group(0), msg)
+
+    def on_other(self, msg, match):
+        print('Other course', match.group(0), msg)
+
+    def no_courses_mentioned(self, msg):
+        print('No courses mentioned ...', msg)
+
+course_handler = CourseHandler()
+course_router = telepot.aio.helper.Router(by_regexes(lambda msg: msg['text'],
+                                                     [('CS[0-9]{3}', 'cs'),
+                                                      ('[A-Z]{2,4}[0-9]{3}', 'other')]),
+                                            make_routing_table(course_handler, [
+                                                'cs',
+                                                'other',
+                                                ((None,), course_handler.no_courses_mentioned),
+                                            ]))
+
+async def fake3a():
+    messages = [{'text': 'I want to take CS101.'},  # both regexes match, first one wins
+                {'text': 'MATH201 is hard.'},
+                {'text': 'MATH201 or CS101?'},  # first regex wins, not first in text
+                {'text': 'I hate computer science!'},]
+    make_message_like(messages)
+
+    for msg in messages:
+        await course_router.route(msg)
+    print()
+
+
 TOKEN = sys.argv[1]
 
 bot = telepot.aio.Bot(TOKEN)
@@ -163,7 +216,9 @@ loop = asyncio.get_event_loop()
 loop.run_until_complete(fake0())
 loop.run_until_complete(fake1())
 loop.run_until_complete(fake2())
+loop.run_until_complete(fake2a())
 loop.run_until_complete(fake3())
+loop.run_until_complete(fake3a())
 
 print('Send me some messages ...')
 loop.create_task(bot.message_loop())